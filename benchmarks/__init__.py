@@ -0,0 +1,2 @@
+from .synthetic import make_drift, make_stack, load_truth
+from .scenarios import SCENARIOS, get_scenario
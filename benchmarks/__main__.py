@@ -0,0 +1,47 @@
+import sys
+import json
+import argparse
+
+from .scenarios import SCENARIOS
+from .run import WORK_DIR, RESULTS_DIR, run_scenario, save_results, print_results, compare_results
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmarks of the FIBSEM pipeline on synthetic stacks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_run = subparsers.add_parser("run", help="Run scenarios and save their results")
+    parser_run.add_argument("scenarios", nargs="*", default=["smoke"], help=f"Scenarios to run: {', '.join(SCENARIOS)} (default: smoke)")
+    parser_run.add_argument("--repeat", type=int, default=3, help="Runs per stage, the median time is reported")
+    parser_run.add_argument("--work-dir", default=WORK_DIR, help="Where the synthetic stacks are generated and kept between runs")
+    parser_run.add_argument("--results-dir", default=RESULTS_DIR, help="Where the JSON results are written")
+    parser_run.add_argument("--compare", default=None, help="JSON results of a previous run to compare against")
+
+    parser_compare = subparsers.add_parser("compare", help="Compare two JSON results of the same scenario")
+    parser_compare.add_argument("reference", help="JSON results of the reference run")
+    parser_compare.add_argument("results", help="JSON results of the new run")
+    parser_compare.add_argument("--tolerance", type=float, default=0.1, help="Relative throughput loss reported as a regression")
+    return parser
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+
+    regressions = []
+    if args.command=="run":
+        for name in args.scenarios:
+            results = run_scenario(name, args.repeat, args.work_dir)
+            print_results(results)
+            print(f"Results saved to {save_results(results, args.results_dir)}")
+            if args.compare is not None:
+                regressions += compare_results(load_results(args.compare), results)
+    else:
+        regressions = compare_results(load_results(args.reference), load_results(args.results), args.tolerance)
+
+    if len(regressions)>0:
+        sys.exit(1)
+
+if __name__=="__main__":
+    main()
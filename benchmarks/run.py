@@ -0,0 +1,152 @@
+import os
+import json
+import shutil
+import tempfile
+import platform
+import subprocess
+import numpy as np
+from time import time, perf_counter
+
+from utils import *
+from .synthetic import make_stack, load_truth, TRUTH_NAME
+from .scenarios import get_scenario
+
+WORK_DIR = os.path.join(tempfile.gettempdir(), "fib_registration_benchmarks")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+def get_commit():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit+"-dirty" if status!="" else commit
+
+def get_stack(name, stack_params, work_dir):
+    path = os.path.join(work_dir, name, "stack")
+    request = json.loads(json.dumps(stack_params))
+    if os.path.exists(os.path.join(path, TRUTH_NAME)):
+        truth = load_truth(path)
+        if truth.get("request")==request:
+            return path, truth
+        shutil.rmtree(path)
+    make_stack(path, **stack_params)
+    with open(os.path.join(path, TRUTH_NAME)) as f:
+        truth = json.load(f)
+    truth["request"] = request
+    with open(os.path.join(path, TRUTH_NAME), "w") as f:
+        json.dump(truth, f)
+    return path, load_truth(path)
+
+def measure(function, n_slices, nbytes, repeat):
+    times, summary, peak_rss = [], None, 0
+    for _ in range(repeat):
+        with Profiler(verbose=False) as profiler:
+            start = perf_counter()
+            result = function()
+            times.append(perf_counter()-start)
+        if summary is None or times[-1]==min(times):
+            summary = profiler.summarize()
+        peak_rss = max(peak_rss, profiler.peak_rss)
+    seconds = float(np.median(times))
+    return result, {"seconds": seconds, "seconds_min": float(np.min(times)), "slices_per_s": n_slices/seconds, "MB_per_s": nbytes/1e6/seconds,
+                    "peak_rss_MB": peak_rss/1e6, "stages": summary}
+
+def get_translation_error(translation, truth):
+    error = (translation-translation[0])-(truth-truth[0])
+    distance = np.linalg.norm(error, axis=1)
+    return {"rms_px": float(np.sqrt(np.mean(distance**2))), "max_px": float(distance.max()), "end_px": float(distance[-1])}
+
+def get_stage_slices(results, stage):
+    return results["stages"].get(stage, {}).get("slices", 0)
+
+def get_means_trend(path, border, saturated_rows):
+    reader = get_reader(path)
+    roi = [border+saturated_rows, reader.shape[0]-border, border, reader.shape[1]-border]
+    means = np.asarray([reader.read(z, roi).mean() for z in range(len(reader))])
+    return float(np.ptp(means)/means.mean())
+
+def run_scenario(name, repeat=3, work_dir=WORK_DIR):
+    scenario = get_scenario(name)
+    stack_path, truth = get_stack(name, scenario["stack"], work_dir)
+    reader = get_reader(stack_path)
+    n_slices = len(reader)
+    nbytes = n_slices*int(np.prod(reader.shape))*reader.dtype.itemsize
+    registration_params = scenario["registration"]
+    out_path = os.path.join(work_dir, name, "out")
+
+    # Spin up the worker pool so that its start-up is not charged to the first stage
+    get_pool(get_n_workers()).submit(len, []).result()
+
+    results = {}
+    _, results["scan"] = measure(lambda: scan_stack(reader, use_cache=False), n_slices, nbytes, repeat)
+
+    padding = PAD_DEFAULT
+    _, results["preprocess"] = measure(lambda: preprocess_data(reader, os.path.join(out_path, "preprocess"), 1, 1, 0, padding, SMOOTH_DEFAULT), n_slices, nbytes, repeat)
+    output = get_reader(os.path.join(out_path, "preprocess"))
+    border = min(padding, truth["zero_border"])
+    expected_shape = [size+2*border for size in truth["shape"]]
+    results["preprocess"]["accuracy"] = {"crop_shape_ok": list(output.shape)==expected_shape,
+                                         "means_trend_before": get_means_trend(stack_path, truth["zero_border"], truth["saturated_rows"]),
+                                         "means_trend_after": get_means_trend(os.path.join(out_path, "preprocess"), border, truth["saturated_rows"])}
+
+    # Static zero borders would pull the correlation towards zero shift, so registration runs on the cropped stack as in the real pipeline
+    if truth["zero_border"]>0:
+        crop_data(reader, os.path.join(out_path, "cropped"), 0)
+        reader = get_reader(os.path.join(out_path, "cropped"))
+
+    (translation, _), results["translation"] = measure(lambda: get_translation(reader, registration_params["upsample_factor"], registration_params["mask_crop_step"],
+                                                        registration_params["pyramid"], return_pairs=True, skip=registration_params["skip"]), n_slices, nbytes, repeat)
+    results["translation"]["accuracy"] = get_translation_error(translation, truth["translation"])
+    results["translation"]["accuracy"]["reads_per_slice"] = get_stage_slices(results["translation"], "read")/n_slices
+
+    # The shared window is the path that reuses the spectra, each slice should be transformed once
+    (translation, _), results["translation_window"] = measure(lambda: get_translation(reader, registration_params["upsample_factor"], registration_params["mask_crop_step"],
+                                                               registration_params["pyramid"], window="shared", return_pairs=True, skip=registration_params["skip"]), n_slices, nbytes, repeat)
+    results["translation_window"]["accuracy"] = get_translation_error(translation, truth["translation"])
+    results["translation_window"]["accuracy"]["spectra_per_slice"] = get_stage_slices(results["translation_window"], "spectrum")/n_slices
+
+    _, results["register"] = measure(lambda: register_frames(reader, truth["translation"], os.path.join(out_path, "register")), n_slices, nbytes, repeat)
+
+    shutil.rmtree(out_path, ignore_errors=True)
+    return {"scenario": name, "commit": get_commit(), "date": time(), "python": platform.python_version(), "numpy": np.__version__, "cpu_count": CPU_COUNT,
+            "n_workers": get_n_workers(), "repeat": repeat, "params": scenario, "results": results}
+
+def save_results(results, results_dir=RESULTS_DIR):
+    make_dir(results_dir)
+    path = os.path.join(results_dir, f"{results['scenario']}_{results['commit']}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    return path
+
+def print_results(results):
+    print(f"Scenario {results['scenario']} at {results['commit']} ({results['n_workers']} workers)")
+    print(f"{'stage':<20}{'seconds':>10}{'slices/s':>10}{'MB/s':>10}{'RSS MB':>10}  accuracy")
+    for stage, values in results["results"].items():
+        accuracy = ", ".join(f"{key}={value:.3g}" if isinstance(value, float) else f"{key}={value}" for key, value in values.get("accuracy", {}).items())
+        print(f"{stage:<20}{values['seconds']:>10.2f}{values['slices_per_s']:>10.1f}{values['MB_per_s']:>10.1f}{values['peak_rss_MB']:>10.0f}  {accuracy}")
+
+def compare_results(reference, results, tolerance=0.1, error_tolerance=0.05):
+    regressions = []
+    print(f"Scenario {results['scenario']}: {reference['commit']} -> {results['commit']}")
+    for stage, values in results["results"].items():
+        if stage not in reference["results"]:
+            continue
+        old = reference["results"][stage]
+        ratio = values["slices_per_s"]/old["slices_per_s"]
+        line = f"{stage:<12}{old['slices_per_s']:>10.1f} -> {values['slices_per_s']:<10.1f}x{ratio:.2f}"
+        if ratio<1-tolerance:
+            regressions.append(f"{stage} throughput x{ratio:.2f}")
+        if "accuracy" in values and "rms_px" in values["accuracy"]:
+            old_error, error = old["accuracy"]["rms_px"], values["accuracy"]["rms_px"]
+            line += f"  rms error {old_error:.3f} -> {error:.3f} px"
+            if error>old_error+error_tolerance:
+                regressions.append(f"{stage} rms error +{error-old_error:.3f} px")
+        for key in ["reads_per_slice", "spectra_per_slice"]:
+            if key in values.get("accuracy", {}) and key in old.get("accuracy", {}) and values["accuracy"][key]>old["accuracy"][key]+0.01:
+                regressions.append(f"{stage} {key} {old['accuracy'][key]:.2f} -> {values['accuracy'][key]:.2f}")
+        print(line)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return regressions
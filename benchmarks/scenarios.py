@@ -0,0 +1,30 @@
+REGISTRATION_DEFAULT = {"upsample_factor": 100, "mask_crop_step": 50, "pyramid": 1, "skip": 1}
+
+SCENARIOS = {
+    "smoke": {
+        "stack": {"n_slices": 16, "shape": (256, 256), "zero_border": 16},
+        "registration": {"upsample_factor": 20, "mask_crop_step": 16},
+    },
+    "default": {
+        "stack": {"n_slices": 64, "shape": (1024, 1024), "zero_border": 32},
+        "registration": {},
+    },
+    "drift": {
+        "stack": {"n_slices": 64, "shape": (512, 512), "drift_step": 2.0, "jump_every": 16},
+        "registration": {"skip": 3},
+    },
+    "pyramid": {
+        "stack": {"n_slices": 64, "shape": (1024, 1024), "drift_step": 4.0},
+        "registration": {"pyramid": 4},
+    },
+    "large": {
+        "stack": {"n_slices": 128, "shape": (2048, 2048), "zero_border": 64},
+        "registration": {},
+    },
+}
+
+def get_scenario(name):
+    if name not in SCENARIOS:
+        raise ValueError(f"Unknown scenario {name}, use one of {', '.join(SCENARIOS)}")
+    scenario = SCENARIOS[name]
+    return {"stack": dict(scenario["stack"]), "registration": {**REGISTRATION_DEFAULT, **scenario["registration"]}}
@@ -0,0 +1,55 @@
+import os
+import json
+import tifffile
+import numpy as np
+from scipy.ndimage import gaussian_filter, shift
+
+TRUTH_NAME = "truth.json"
+
+def make_drift(n_slices, drift_step=1.0, jump_every=None, jump_size=10.0, seed=0):
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(0, drift_step, (n_slices, 2))
+    if jump_every is not None:
+        steps[jump_every::jump_every] += rng.choice([-1, 1], (len(steps[jump_every::jump_every]), 2))*jump_size
+    steps[0] = 0
+    return np.cumsum(steps, axis=0)
+
+def make_texture(shape, feature_size=3, seed=0):
+    rng = np.random.default_rng(seed)
+    texture = gaussian_filter(rng.random(shape), feature_size)
+    return (texture-texture.min())/(texture.max()-texture.min())
+
+def make_stack(save_path, n_slices=32, shape=(512, 512), drift_step=1.0, jump_every=None, intensity_trend=0.2, noise=2.0,
+               saturated_fraction=0.1, zero_border=0, seed=0):
+    os.makedirs(save_path, exist_ok=True)
+    drift = make_drift(n_slices, drift_step, jump_every, seed=seed)
+    margin = int(np.ceil(np.abs(drift).max()))+8
+    texture = make_texture((shape[0]+2*margin, shape[1]+2*margin), seed=seed)
+    rng = np.random.default_rng(seed+1)
+
+    # The sample is shifted by drift[z], so registration should find translation[z] = -drift[z]
+    saturated_rows = int(shape[0]*saturated_fraction)
+    means = []
+    for z in range(n_slices):
+        frame = shift(texture, drift[z], order=1)[margin:margin+shape[0],margin:margin+shape[1]]
+        gain = 1+intensity_trend*z/max(n_slices-1, 1)
+        frame = (frame*160+40)*gain+rng.normal(0, noise, shape)
+        frame = np.clip(frame, 1, 254).astype('uint8')
+        frame[:saturated_rows] = 255
+        means.append(float(frame[frame<255].mean()))
+        if zero_border>0:
+            frame = np.pad(frame, zero_border)
+        tifffile.imwrite(os.path.join(save_path, f"slice_{z:05d}.tif"), frame)
+
+    truth = {"translation": (-drift).tolist(), "shape": list(shape), "zero_border": zero_border, "saturated_rows": saturated_rows,
+             "means": means, "params": {"n_slices": n_slices, "drift_step": drift_step, "jump_every": jump_every, "intensity_trend": intensity_trend,
+                                        "noise": noise, "saturated_fraction": saturated_fraction, "seed": seed}}
+    with open(os.path.join(save_path, TRUTH_NAME), "w") as f:
+        json.dump(truth, f)
+    return truth
+
+def load_truth(path):
+    with open(os.path.join(path, TRUTH_NAME)) as f:
+        truth = json.load(f)
+    truth["translation"] = np.asarray(truth["translation"])
+    return truth
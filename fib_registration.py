@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import argparse
+
+from utils import *
+
+TASKS = {"register": "registration", "registration": "registration", "preprocess": "preprocessing", "preprocessing": "preprocessing"}
+
+def make_params(options):
+    params = {}
+    params["task"] = TASKS[options["task"]]
+    params["crop"] = int(options.get("crop", 0))
+    params["norm"] = int(options.get("norm", 0))
+    params["invert"] = int(options.get("invert", 0))
+
+    experiments = options["experiments"]
+    params["numexp"] = len(experiments)
+    params["load_paths"] = [experiment["load_path"] for experiment in experiments]
+    params["save_paths"] = [experiment["save_path"] for experiment in experiments]
+    params["crop_start"] = [experiment.get("crop_start", 0) for experiment in experiments]
+    params["crop_end"] = [experiment.get("crop_end", None) for experiment in experiments]
+
+    params["pad"] = int(options.get("pad", PAD_DEFAULT))
+    params["smooth"] = int(options.get("smooth", SMOOTH_DEFAULT))
+    params["norm_mode"] = options.get("norm_mode", NORM_MODE_DEFAULT)
+    params["lookahead"] = None if options.get("lookahead", None) is None else int(options["lookahead"])
+    params["upsample"] = int(options.get("upsample", UPSAMPLE_DEFAULT))
+    params["maskcrop"] = int(options.get("maskcrop", MASKCROP_DEFAULT))
+    params["pyramid"] = int(options.get("pyramid", PYRAMID_DEFAULT))
+    params["pyramid_window"] = int(options.get("pyramid_window", PYRAMID_WINDOW_DEFAULT) or 0)
+    params["skip"] = int(options.get("skip", SKIP_DEFAULT))
+    params["interpolation"] = options.get("interpolation", INTERPOLATION_DEFAULT)
+    params["shared_window"] = int(options.get("shared_window", 0))
+    params["fft_workers"] = int(options.get("fft_workers", 1))
+    params["roi"] = None if options.get("roi", None) is None else [int(value) for value in options["roi"]]
+    params["roi_margin"] = int(options.get("roi_margin", ROI_MARGIN_DEFAULT))
+    params["preview"] = None if options.get("preview", None) is None else int(options["preview"])
+    params["compression"] = options.get("compression", "none")
+    params["predictor"] = int(options.get("predictor", 0))
+    params["tile"] = None if options.get("tile", None) is None else int(options["tile"])
+    params["multipage"] = int(options.get("multipage", 0))
+    params["zarr"] = int(options.get("zarr", 0))
+    params["n5"] = int(options.get("n5", 0))
+    params["chunks"] = tuple(int(size) for size in options.get("chunks", ZARR_CHUNKS_DEFAULT))
+    params["levels"] = int(options.get("levels", 1))
+    params["reuse"] = int(options.get("reuse", 0))
+    params["resume"] = int(options.get("resume", 0))
+    params["simultaneous"] = bool(options.get("simultaneous", False))
+    params["max_experiments"] = int(options.get("max_experiments", 1))
+    params["n_workers"] = int(options.get("n_workers", CPU_COUNT))
+    params["io_limit"] = int(options.get("io_limit", 4))
+    return params
+
+def check_params(params, planned_paths=()):
+    if params["task"]=="preprocessing" and params["crop"]+params["norm"]+params["invert"]==0:
+        return "Select at least one subtask (crop, norm, invert)"
+    if params["norm_mode"] not in ["global", "streaming"]:
+        return "Normalization mode should be global or streaming"
+    if params["roi"] is not None and (len(params["roi"])!=4 or params["roi"][1]<=params["roi"][0] or params["roi"][3]<=params["roi"][2]):
+        return "The ROI should be given as Y_MIN Y_MAX X_MIN X_MAX"
+    if params["preview"] is not None and params["preview"]<1:
+        return "The preview binning should be at least 1"
+    if params["compression"] not in TIFF_COMPRESSIONS:
+        return "Compression should be one of "+", ".join(TIFF_COMPRESSIONS)
+    if params["tile"] is not None and (params["tile"]<16 or params["tile"]%16!=0):
+        return "The TIFF tile size should be a multiple of 16"
+    if params["pyramid_window"]!=0 and params["pyramid_window"]<32:
+        return "The pyramid window should be 0 (the whole overlap) or at least 32 pixels"
+    if params["interpolation"] not in INTERPOLATIONS:
+        return "Interpolation should be one of "+", ".join(INTERPOLATIONS)
+    if params["fft_workers"]<1:
+        return "FFT workers should be at least 1"
+    if params["multipage"]+params["zarr"]+params["n5"]>1:
+        return "Select only one of multipage, zarr and n5 output"
+    if len(params["chunks"])!=3 or min(params["chunks"])<1:
+        return "The Zarr chunks should be given as Z Y X"
+    if params["levels"]<1 or params["chunks"][0]%2**(params["levels"]-1)!=0:
+        return "The chunk depth should be divisible by 2**(levels-1)"
+    if params["skip"]<1:
+        return "Pair skip should be at least 1"
+    if params["numexp"]==0:
+        return "No experiments given"
+    for i in range(params["numexp"]):
+        if not os.path.exists(params["load_paths"][i]) and os.path.normpath(params["load_paths"][i]) not in planned_paths:
+            return "Load path #"+str(i+1)+" does not exist"
+        if params["save_paths"][i] in ["", None]:
+            return "Please specify save path #"+str(i+1)
+        if params["crop_end"][i] not in ["", None]:
+            if int(params["crop_end"][i])<=int(params["crop_start"][i]):
+                return "Crop start #"+str(i+1)+" should be smaller than its corresponding crop end"
+    return None
+
+def load_jobs(path):
+    with open(path) as f:
+        if path.lower().endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("YAML job files require the PyYAML package (pip install pyyaml)")
+            jobs = yaml.safe_load(f)
+        else:
+            jobs = json.load(f)
+    if isinstance(jobs, dict):
+        jobs = jobs.get("jobs", [jobs])
+    return [make_params(job) for job in jobs]
+
+def add_common_arguments(parser):
+    parser.add_argument("load_path", help="Input stack: a dir of .tif slices, a multipage .tif or a Zarr array")
+    parser.add_argument("save_path", help="Output dir")
+    parser.add_argument("--crop-start", type=int, default=0, help="First slice to process")
+    parser.add_argument("--crop-end", type=int, default=None, help="Slice to stop at (default: end of the stack)")
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
+
+def add_output_arguments(parser):
+    parser.add_argument("--compression", choices=list(TIFF_COMPRESSIONS), default="none", help="Lossless compression of the output TIFFs (lzw and zstd need the imagecodecs package)")
+    parser.add_argument("--predictor", action="store_true", help="Apply horizontal differencing before the compression")
+    parser.add_argument("--tile", type=int, default=None, help="Write the slices as square tiles of this size (a multiple of 16) instead of strips")
+    parser.add_argument("--multipage", action="store_true", help="Write the whole stack as a single BigTIFF, SAVE_PATH/"+MULTIPAGE_NAME)
+    parser.add_argument("--zarr", action="store_true", help="Write SAVE_PATH as an OME-Zarr group instead of TIFFs (needs the zarr package)")
+    parser.add_argument("--n5", action="store_true", help="Write SAVE_PATH as an N5 container instead of TIFFs (needs zarr<3)")
+    parser.add_argument("--chunks", type=int, nargs=3, metavar=("Z", "Y", "X"), default=ZARR_CHUNKS_DEFAULT, help="With --zarr or --n5, chunk shape of the output")
+    parser.add_argument("--levels", type=int, default=1, help="With --zarr or --n5, number of resolution levels, each downsampled by 2")
+
+def add_profile_arguments(parser):
+    parser.add_argument("--profile", dest="profile_path", default=None, help="Record per-stage timings and write them to PROFILE.json/.csv")
+    parser.add_argument("--cprofile", action="store_true", help="Also run the workers under cProfile and write the merged stats to PROFILE.prof")
+
+def add_scheduler_arguments(parser):
+    parser.add_argument("--max-experiments", type=int, default=None, help="Number of experiments processed concurrently")
+    parser.add_argument("--workers", dest="n_workers", type=int, default=None, help="Worker processes shared by all experiments (default: all cores)")
+    parser.add_argument("--io-limit", type=int, default=None, help="Maximum number of concurrent I/O-bound tasks")
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog="python -m fib_registration", description="FIBSEM preprocessing and registration")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_register = subparsers.add_parser("register", help="Register one stack")
+    add_common_arguments(parser_register)
+    parser_register.add_argument("--upsample", type=int, default=UPSAMPLE_DEFAULT, help="Translations are estimated up to 1/(upsample factor) precision")
+    parser_register.add_argument("--maskcrop", type=int, default=MASKCROP_DEFAULT, help="Block size (in pixels) of the coarse grid used for finding the largest rectangle inside the cell")
+    parser_register.add_argument("--pyramid", type=int, default=PYRAMID_DEFAULT, choices=[1,2,4], help="Downsampling factor of the coarse translation estimate (1 disables it)")
+    parser_register.add_argument("--pyramid-window", type=int, default=PYRAMID_WINDOW_DEFAULT, help="With --pyramid, size (in pixels) of the full resolution window that refines the coarse estimate. 0 uses the whole overlap, as accurate as --pyramid 1 but not faster. Smaller windows are faster but noisier: about 2 times the error per pair with 512 and 4 times with 256, and the error adds up along Z")
+    parser_register.add_argument("--skip", type=int, default=SKIP_DEFAULT, help="Also correlate each frame with the frames up to this many slices before it and solve the translations jointly (1 only correlates neighbours). Each extra pair costs a full correlation, unless --shared-window is set, where the frame spectra are reused")
+    parser_register.add_argument("--interpolation", choices=INTERPOLATIONS, default=INTERPOLATION_DEFAULT, help="How the frames are shifted by subpixel translations (integer rounds them)")
+    parser_register.add_argument("--shared-window", action="store_true", help="Correlate all the frames in one rectangle that lies inside the cell in every frame, so that each frame is transformed only once")
+    parser_register.add_argument("--fft-workers", type=int, default=1, help="Threads per Fourier transform (the frames are already processed in parallel)")
+    parser_register.add_argument("--roi", type=int, nargs=4, metavar=("Y_MIN", "Y_MAX", "X_MIN", "X_MAX"), default=None, help="Only register and export this region (in the coordinates of the first slice)")
+    parser_register.add_argument("--roi-margin", type=int, default=ROI_MARGIN_DEFAULT, help="Margin (in pixels) added around the ROI")
+    parser_register.add_argument("--preview", type=int, nargs="?", const=PREVIEW_BIN_DEFAULT, default=None, metavar="BIN", help="Also write a binned volume (BIN=4 by default), XZ/YZ reslices through the centre and a plot of the translation to SAVE_PATH/"+PREVIEW_NAME)
+    parser_register.add_argument("--reuse", action="store_true", help="Apply the "+TRANSLATION_NAME+" found in the save path instead of estimating it")
+    parser_register.add_argument("--resume", action="store_true", help="Keep the saved translation if it matches the current settings, and only register the frames whose output is missing or stale")
+    parser_register.add_argument("--follow", action="store_true", help="Keep watching the load path and register slices as they are acquired (stop with Ctrl+C)")
+    parser_register.add_argument("--margin", type=int, default=MARGIN_DEFAULT, help="With --follow, fixed padding (in pixels) of the output canvas, since the final drift is not known yet")
+    parser_register.add_argument("--poll", type=float, default=POLL_DEFAULT, help="With --follow, seconds between two scans of the load path")
+    parser_register.add_argument("--idle-timeout", type=float, default=None, help="With --follow, stop after this many seconds without a new slice")
+
+    parser_preprocess = subparsers.add_parser("preprocess", help="Preprocess one stack")
+    add_common_arguments(parser_preprocess)
+    parser_preprocess.add_argument("--crop", action="store_true", help="Crop the data to its nonzero bounding box")
+    parser_preprocess.add_argument("--norm", action="store_true", help="Normalize the intensity along Z")
+    parser_preprocess.add_argument("--invert", action="store_true", help="Invert the intensities")
+    parser_preprocess.add_argument("--pad", type=int, default=PAD_DEFAULT, help="Padding (in pixels) added around the data after it is cropped")
+    parser_preprocess.add_argument("--smooth", type=int, default=SMOOTH_DEFAULT, help="Strength of the smoothing of the per-frame means curve")
+    parser_preprocess.add_argument("--norm-mode", choices=["global", "streaming"], default=NORM_MODE_DEFAULT, help="global scans the whole stack first, streaming only looks a few frames ahead")
+    parser_preprocess.add_argument("--lookahead", type=int, default=None, help="With --norm-mode streaming, number of frames read ahead (default: the full smoothing kernel, which matches the global means curve)")
+
+    parser_run = subparsers.add_parser("run", help="Run the jobs described in JSON/YAML job files")
+    parser_run.add_argument("job_files", nargs="+", help="Job files, each holding one job or a list of jobs")
+    add_scheduler_arguments(parser_run)
+    add_profile_arguments(parser_run)
+    return parser
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+
+    if args.command=="run":
+        jobs = [params for job_file in args.job_files for params in load_jobs(job_file)]
+        for params in jobs:
+            for key in ["max_experiments", "n_workers", "io_limit"]:
+                if getattr(args, key) is not None:
+                    params[key] = getattr(args, key)
+    elif args.command=="register" and args.follow==True:
+        if not os.path.isdir(args.load_path):
+            sys.exit("Error: --follow needs a directory of .tif slices as load path")
+        if args.multipage==True or args.zarr==True or args.n5==True:
+            sys.exit("Error: --follow writes one .tif per slice and cannot be combined with --multipage, --zarr or --n5")
+        writer = TiffWriter(args.save_path, args.compression, args.predictor, args.tile)
+        follow_registration(args.load_path, args.save_path, args.upsample, args.maskcrop, args.pyramid, args.interpolation, margin=args.margin, poll_interval=args.poll, idle_timeout=args.idle_timeout, writer=writer)
+        return
+    else:
+        options = vars(args).copy()
+        options["task"] = args.command
+        options["experiments"] = [{"load_path": args.load_path, "save_path": args.save_path, "crop_start": args.crop_start, "crop_end": args.crop_end}]
+        jobs = [make_params(options)]
+
+    # A job may read the output of an earlier one, which does not exist yet
+    planned_paths = set()
+    for i, params in enumerate(jobs):
+        message = check_params(params, planned_paths)
+        if message is not None:
+            sys.exit(f"Error in job #{i+1}: {message}")
+        planned_paths.update(os.path.normpath(save_path) for save_path in params["save_paths"])
+
+    for i, params in enumerate(jobs):
+        profile_path = args.profile_path
+        if profile_path is not None and len(jobs)>1:
+            profile_path = f"{profile_path}_{i+1}"
+        run_experiments(params, params["simultaneous"], params["max_experiments"], params["n_workers"], params["io_limit"], profile_path, args.cprofile)
+
+if __name__=="__main__":
+    main()
@@ -11,11 +11,6 @@ FRAME_RELIEF = tk.RAISED
 FRAME_BORDERWIDTH = 1
 WIDGET_PAD = 3
 
-PAD_DEFAULT = 50
-SMOOTH_DEFAULT = 5
-UPSAMPLE_DEFAULT = 100
-MASKCROP_DEFAULT = 50
-
 class ToolTip(object):
     def __init__(self, widget, text):
         self.widget = widget
@@ -185,10 +180,30 @@ class MainFrame(tk.Tk):
         self.var_pad.set(PAD_DEFAULT)
         self.var_smooth = tk.IntVar()
         self.var_smooth.set(SMOOTH_DEFAULT)
+        self.var_streaming = tk.IntVar()
+        self.var_streaming.set(0)
         self.var_upsample = tk.IntVar()
         self.var_upsample.set(UPSAMPLE_DEFAULT)
         self.var_maskcrop = tk.IntVar()
         self.var_maskcrop.set(MASKCROP_DEFAULT)
+        self.var_pyramid = tk.IntVar()
+        self.var_pyramid.set(PYRAMID_DEFAULT)
+        self.var_pyramid_window = tk.IntVar()
+        self.var_pyramid_window.set(PYRAMID_WINDOW_DEFAULT)
+        self.var_skip = tk.IntVar()
+        self.var_skip.set(SKIP_DEFAULT)
+        self.var_interpolation = tk.StringVar()
+        self.var_interpolation.set(INTERPOLATION_DEFAULT)
+        self.var_shared_window = tk.IntVar()
+        self.var_shared_window.set(0)
+        self.var_fft_workers = tk.IntVar()
+        self.var_fft_workers.set(1)
+        self.var_output = tk.StringVar()
+        self.var_output.set(OUTPUT_FORMATS[0])
+        self.var_reuse = tk.IntVar()
+        self.var_reuse.set(0)
+        self.var_resume = tk.IntVar()
+        self.var_resume.set(0)
 
         frame_optional_set = tk.Frame(frame_optional)
         
@@ -208,30 +223,108 @@ class MainFrame(tk.Tk):
         spinbox_smooth.grid(column=1, row=1, padx=WIDGET_PAD, pady=WIDGET_PAD)
         ttip_smooth.grid(column=2, row=1, padx=WIDGET_PAD, pady=WIDGET_PAD)
 
+        checkbutton_streaming = tk.Checkbutton(frame_optional_set, text='Streaming normalization', variable=self.var_streaming, onvalue=1, offvalue=0)
+        ttip_streaming = tk.Label(frame_optional_set, text ="?", relief="raised")      
+        ToolTip(ttip_streaming, "Normalize each frame with the means of its neighbouring frames only, instead of scanning the whole stack first. \nThe intensity level is set by the first frames. \nPart of Preprocessing.")
+        checkbutton_streaming.grid(column=0, row=2, padx=WIDGET_PAD, pady=WIDGET_PAD, columnspan=2)
+        ttip_streaming.grid(column=2, row=2, padx=WIDGET_PAD, pady=WIDGET_PAD)
+
         label_upsample= tk.Label(frame_optional_set, text="Upsample factor:")
         spinbox_upsample = tk.Spinbox(frame_optional_set, from_=1, to=100, textvariable=self.var_upsample, width=3)
         ttip_upsample = tk.Label(frame_optional_set, text ="?", relief="raised")      
         ToolTip(ttip_upsample, "The registration algorithm returns translation values up to 1/(upsample factor) precision. \nIf equal to 1, for example, it will only return integer values. \nPart of Registration.")
-        label_upsample.grid(column=0, row=2, padx=WIDGET_PAD, pady=WIDGET_PAD)
-        spinbox_upsample.grid(column=1, row=2, padx=WIDGET_PAD, pady=WIDGET_PAD)
-        ttip_upsample.grid(column=2, row=2, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        label_upsample.grid(column=0, row=3, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        spinbox_upsample.grid(column=1, row=3, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        ttip_upsample.grid(column=2, row=3, padx=WIDGET_PAD, pady=WIDGET_PAD)
 
         label_maskcrop= tk.Label(frame_optional_set, text="Mask crop step:")
         spinbox_maskcrop = tk.Spinbox(frame_optional_set, from_=1, to=100, textvariable=self.var_maskcrop, width=3)
         ttip_maskcrop = tk.Label(frame_optional_set, text ="?", relief="raised")      
-        ToolTip(ttip_maskcrop, "Step (in pixels) used in the algorithm for finding the largest rectangle inside the cell. \nIncrease it for performance, decrease it for accuracy. \nPart of Registration.")
-        label_maskcrop.grid(column=0, row=3, padx=WIDGET_PAD, pady=WIDGET_PAD)
-        spinbox_maskcrop.grid(column=1, row=3, padx=WIDGET_PAD, pady=WIDGET_PAD)
-        ttip_maskcrop.grid(column=2, row=3, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        ToolTip(ttip_maskcrop, "Block size (in pixels) of the coarse grid used for finding the largest rectangle inside the cell. \nThe rectangle is then grown back at full resolution, so this mostly affects speed. \nPart of Registration.")
+        label_maskcrop.grid(column=0, row=4, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        spinbox_maskcrop.grid(column=1, row=4, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        ttip_maskcrop.grid(column=2, row=4, padx=WIDGET_PAD, pady=WIDGET_PAD)
+
+        label_pyramid= tk.Label(frame_optional_set, text="Pyramid factor:")
+        spinbox_pyramid = tk.Spinbox(frame_optional_set, values=(1,2,4), textvariable=self.var_pyramid, width=3)
+        ttip_pyramid = tk.Label(frame_optional_set, text ="?", relief="raised")      
+        ToolTip(ttip_pyramid, "Downsampling factor used for a coarse estimate of the translation, which is then refined at full resolution in the pyramid window. \nIf equal to 1, the translation is estimated at full resolution only. \nPart of Registration.")
+        label_pyramid.grid(column=0, row=5, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        spinbox_pyramid.grid(column=1, row=5, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        ttip_pyramid.grid(column=2, row=5, padx=WIDGET_PAD, pady=WIDGET_PAD)
+
+        label_pyramid_window= tk.Label(frame_optional_set, text="Pyramid window:")
+        spinbox_pyramid_window = tk.Spinbox(frame_optional_set, values=(0,256,512,1024,2048), textvariable=self.var_pyramid_window, width=5)
+        ttip_pyramid_window = tk.Label(frame_optional_set, text ="?", relief="raised")      
+        ToolTip(ttip_pyramid_window, "Size (in pixels) of the full resolution window that refines the coarse pyramid estimate. \nSmaller windows are faster but each pair gets noisier (about 2 times with 512 and 4 times with 256), and the error adds up along Z. \nIf equal to 0, the whole overlap is used: as accurate as a pyramid factor of 1, but not faster. \nPart of Registration.")
+        label_pyramid_window.grid(column=0, row=6, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        spinbox_pyramid_window.grid(column=1, row=6, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        ttip_pyramid_window.grid(column=2, row=6, padx=WIDGET_PAD, pady=WIDGET_PAD)
+
+        label_skip= tk.Label(frame_optional_set, text="Pair skip:")
+        spinbox_skip = tk.Spinbox(frame_optional_set, from_=1, to=8, textvariable=self.var_skip, width=3)
+        ttip_skip = tk.Label(frame_optional_set, text ="?", relief="raised")      
+        ToolTip(ttip_skip, "Each frame is also correlated with the frames up to this many slices before it, and the translations are solved jointly to limit the drift along Z. \nEach extra pair costs a full correlation, unless the shared correlation window is used, where the spectrum of each frame is reused. \nIf equal to 1, only neighbouring frames are correlated. \nPart of Registration.")
+        label_skip.grid(column=0, row=7, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        spinbox_skip.grid(column=1, row=7, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        ttip_skip.grid(column=2, row=7, padx=WIDGET_PAD, pady=WIDGET_PAD)
+
+        label_interpolation= tk.Label(frame_optional_set, text="Interpolation:")
+        combobox_interpolation = ttk.Combobox(frame_optional_set, values=INTERPOLATIONS, textvariable=self.var_interpolation, state="readonly", width=8)
+        ttip_interpolation = tk.Label(frame_optional_set, text ="?", relief="raised")      
+        ToolTip(ttip_interpolation, "How the frames are shifted by subpixel translations. \nInteger rounds the translation and copies the pixels, bilinear is fast, spline is smoother and fourier is exact for band-limited images but the slowest. \nPart of Registration.")
+        label_interpolation.grid(column=0, row=8, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        combobox_interpolation.grid(column=1, row=8, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        ttip_interpolation.grid(column=2, row=8, padx=WIDGET_PAD, pady=WIDGET_PAD)
+
+        checkbutton_shared_window = tk.Checkbutton(frame_optional_set, text='Shared correlation window', variable=self.var_shared_window, onvalue=1, offvalue=0)
+        ttip_shared_window = tk.Label(frame_optional_set, text ="?", relief="raised")      
+        ToolTip(ttip_shared_window, "Correlate all the frames in one rectangle that lies inside the cell in every frame, instead of a rectangle per pair. \nEach frame is then transformed only once, which is faster, but the rectangle can be small if the cell moves a lot. \nPart of Registration.")
+        checkbutton_shared_window.grid(column=0, row=9, padx=WIDGET_PAD, pady=WIDGET_PAD, columnspan=2)
+        ttip_shared_window.grid(column=2, row=9, padx=WIDGET_PAD, pady=WIDGET_PAD)
+
+        label_fft_workers= tk.Label(frame_optional_set, text="FFT threads:")
+        spinbox_fft_workers = tk.Spinbox(frame_optional_set, from_=1, to=CPU_COUNT, textvariable=self.var_fft_workers, width=3)
+        ttip_fft_workers = tk.Label(frame_optional_set, text ="?", relief="raised")      
+        ToolTip(ttip_fft_workers, "Threads used by each Fourier transform. \nOnly worth raising when there are fewer frames than cores, since the frames are already processed in parallel. \nPart of Registration.")
+        label_fft_workers.grid(column=0, row=10, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        spinbox_fft_workers.grid(column=1, row=10, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        ttip_fft_workers.grid(column=2, row=10, padx=WIDGET_PAD, pady=WIDGET_PAD)
+
+        label_output= tk.Label(frame_optional_set, text="Output format:")
+        combobox_output = ttk.Combobox(frame_optional_set, values=OUTPUT_FORMATS, textvariable=self.var_output, state="readonly", width=10)
+        ttip_output = tk.Label(frame_optional_set, text ="?", relief="raised")      
+        ToolTip(ttip_output, "tiff: one .tif per slice in the save dir. \nmultipage: a single BigTIFF, "+MULTIPAGE_NAME+", in the save dir. \nzarr/n5: the save dir is written as an OME-Zarr group or an N5 container (needs the zarr package). \nPart of Preprocessing and Registration.")
+        label_output.grid(column=0, row=11, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        combobox_output.grid(column=1, row=11, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        ttip_output.grid(column=2, row=11, padx=WIDGET_PAD, pady=WIDGET_PAD)
+
+        checkbutton_reuse = tk.Checkbutton(frame_optional_set, text='Reuse saved translation', variable=self.var_reuse, onvalue=1, offvalue=0)
+        checkbutton_resume = tk.Checkbutton(frame_optional_set, text='Resume', variable=self.var_resume, onvalue=1, offvalue=0)
+        ttip_saved = tk.Label(frame_optional_set, text ="?", relief="raised")      
+        ToolTip(ttip_saved, "Reuse saved translation: skip the translation estimation and apply the "+TRANSLATION_NAME+" file found in the save dir. \nResume: keep the saved translation if it was estimated with the same settings, and only register the frames whose output is missing or older than its input. \nPart of Registration.")
+        checkbutton_reuse.grid(column=0, row=12, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        checkbutton_resume.grid(column=1, row=12, padx=WIDGET_PAD, pady=WIDGET_PAD)
+        ttip_saved.grid(column=2, row=12, padx=WIDGET_PAD, pady=WIDGET_PAD)
 
         def reset_optional():
             self.var_pad.set(PAD_DEFAULT)
             self.var_smooth.set(SMOOTH_DEFAULT)
+            self.var_streaming.set(0)
             self.var_upsample.set(UPSAMPLE_DEFAULT)
             self.var_maskcrop.set(MASKCROP_DEFAULT)
+            self.var_pyramid.set(PYRAMID_DEFAULT)
+            self.var_pyramid_window.set(PYRAMID_WINDOW_DEFAULT)
+            self.var_skip.set(SKIP_DEFAULT)
+            self.var_interpolation.set(INTERPOLATION_DEFAULT)
+            self.var_shared_window.set(0)
+            self.var_fft_workers.set(1)
+            self.var_output.set(OUTPUT_FORMATS[0])
+            self.var_reuse.set(0)
+            self.var_resume.set(0)
 
         button_reset = tk.Button(frame_optional_set, text="Reset to default", command=reset_optional)
-        button_reset.grid(column=0, row=4, padx=WIDGET_PAD, pady=WIDGET_PAD, columnspan=3)
+        button_reset.grid(column=0, row=13, padx=WIDGET_PAD, pady=WIDGET_PAD, columnspan=3)
  
 
         ############################################ RUN
@@ -271,8 +364,29 @@ class MainFrame(tk.Tk):
 
             self.params["pad"] = self.var_pad.get()
             self.params["smooth"] = self.var_smooth.get()
+            self.params["norm_mode"] = "streaming" if self.var_streaming.get()==1 else "global"
+            self.params["lookahead"] = None
             self.params["upsample"] = self.var_upsample.get()
             self.params["maskcrop"] = self.var_maskcrop.get()
+            self.params["pyramid"] = self.var_pyramid.get()
+            self.params["pyramid_window"] = self.var_pyramid_window.get()
+            self.params["skip"] = self.var_skip.get()
+            self.params["interpolation"] = self.var_interpolation.get()
+            self.params["shared_window"] = self.var_shared_window.get()
+            self.params["fft_workers"] = self.var_fft_workers.get()
+            self.params["roi"] = None
+            self.params["roi_margin"] = ROI_MARGIN_DEFAULT
+            self.params["preview"] = None
+            self.params["compression"] = "none"
+            self.params["predictor"] = 0
+            self.params["tile"] = None
+            self.params["multipage"] = int(self.var_output.get()=="multipage")
+            self.params["zarr"] = int(self.var_output.get()=="zarr")
+            self.params["n5"] = int(self.var_output.get()=="n5")
+            self.params["chunks"] = ZARR_CHUNKS_DEFAULT
+            self.params["levels"] = 1
+            self.params["reuse"] = self.var_reuse.get()
+            self.params["resume"] = self.var_resume.get()
 
             return True
 
@@ -296,61 +410,4 @@ app.mainloop()
 
 params = app.params
 
-start = time()
-
-for i in range(params["numexp"]):
-    params["crop_start"][i] = int(params["crop_start"][i])
-    if params["crop_end"][i]=="":
-        params["crop_end"][i] = None
-    else:
-        params["crop_end"][i] = int(params["crop_end"][i])
-
-if params["task"]=="preprocessing":
-    print("Processing data...")
-
-    for i in range(params['numexp']):
-        start_time = time()
-
-        load_path, save_path = params["load_paths"][i], params["save_paths"][i]
-        crop_start, crop_end = params["crop_start"][i], params["crop_end"][i]
-        padding = params["pad"]
-        means_smoothing = params["smooth"]
-
-        filelist = make_filelist(load_path, crop_start, crop_end)
-
-        if params['crop']==1:
-            crop_data(filelist, save_path, padding)
-            filelist = make_filelist(save_path)
-
-        if params['norm']==1:
-            normalize_data(filelist, save_path, means_smoothing)
-            filelist = make_filelist(save_path)
-
-        if params['invert']==1:
-            invert_data(filelist, save_path)
-
-        total_time = time()-start_time
-        print(f"Exp #{i+1} finished in {total_time:.2f}s")
-
-if params["task"]=="registration":
-    print("Registering data...")
-
-    for i in range(params['numexp']):
-        start_time = time()
-
-        load_path, save_path = params["load_paths"][i], params["save_paths"][i]
-        crop_start, crop_end = params["crop_start"][i], params["crop_end"][i]
-        upsample_factor = params["upsample"]
-        mask_crop_step = params["maskcrop"]
-
-        make_dir(save_path)
-        filelist = make_filelist(load_path, crop_start, crop_end)
-        if i==0:
-            translation = get_translation(filelist, upsample_factor, mask_crop_step)
-        register_frames(filelist, translation, save_path)
-
-        total_time = time()-start_time
-        print(f'Exp #{i+1} finished in {total_time:.2f}s')
-
-code_time = time()-start
-print(f"Code finished in {code_time:.2f}s")
+run_experiments(params, simultaneous=True)
@@ -1,15 +1,49 @@
-import os, glob
+import os, io, glob, json, hashlib, copy, threading, tempfile, resource, cProfile, pstats
 import tifffile
 import numpy as np
-import matplotlib.pyplot as plt
-from time import time
-from scipy.ndimage import shift, gaussian_filter
-from skimage.registration import phase_cross_correlation
+from time import time, perf_counter, sleep
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import shift, gaussian_filter, fourier_shift, median_filter
+from scipy.fft import rfft2, irfft2, fftfreq, rfftfreq
+from scipy.sparse import coo_matrix
+from scipy.sparse.linalg import spsolve
 
-from joblib import Parallel, delayed
 from multiprocessing import cpu_count
 
 CPU_COUNT = cpu_count()
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+POOL_TIMEOUT = 3600
+
+PAD_DEFAULT = 50
+SMOOTH_DEFAULT = 5
+UPSAMPLE_DEFAULT = 100
+MASKCROP_DEFAULT = 50
+PYRAMID_DEFAULT = 1
+PYRAMID_WINDOW_DEFAULT = 512
+INTERPOLATION_DEFAULT = "spline"
+SKIP_DEFAULT = 1
+MARGIN_DEFAULT = 200
+POLL_DEFAULT = 10
+NORM_MODE_DEFAULT = "global"
+MEMORY_FRACTION = 0.8
+ROI_MARGIN_DEFAULT = 100
+PREVIEW_BIN_DEFAULT = 4
+PREVIEW_NAME = "preview"
+MULTIPAGE_NAME = "registered.tif"
+ZARR_CHUNKS_DEFAULT = (16, 256, 256)
+OUTPUT_FORMATS = ["tiff", "multipage", "zarr", "n5"]
+TIFF_COMPRESSIONS = {"none": None, "deflate": "zlib", "lzw": "lzw", "zstd": "zstd"}
+QC_ERROR, QC_AREA, QC_SHIFT, QC_REFINED = 1, 2, 4, 8
+QC_MIN_AREA = 0.05
+QC_DEVIATIONS = 4
+QC_MIN_ERROR_RATIO = 1.5
+QC_MIN_SHIFT = 2.0
+QC_WINDOW = 15
+# Working memory per pixel of the padded footprint: float32 source and output, plus the float64 spline coefficients or the complex spectrum
+WARP_BYTES_PER_PIXEL = {"integer": 0, "bilinear": 8, "spline": 16, "fourier": 16}
+INTERPOLATIONS = list(WARP_BYTES_PER_PIXEL)
 
 def make_dir(path):
     if not os.path.exists(path):
@@ -18,166 +52,1166 @@ def make_dir(path):
 def make_filelist(path, crop_start=0, crop_end=None):
     return sorted(glob.glob(os.path.join(path, '*.tif')))[crop_start:crop_end]
 
-def get_bounds(filelist, padding):
-    frame_shape = tifffile.imread(filelist[0]).shape
-
-    is_mask_zero = True
-    test_frame = tifffile.imread(filelist[0])
-    mask = (test_frame>0).astype('int')
-    if np.max(mask) - np.min(mask) == 0:
-        is_mask_zero = False
-
-    def loop(file):
-        frame = tifffile.imread(file)
-        if is_mask_zero == True:
-            indices = np.where(frame>0)
-        else:
-            indices = np.where(frame<255)
-        return [indices[0].min(), indices[0].max(), indices[1].min(), indices[1].max()]
-
-    n_jobs = np.minimum(CPU_COUNT,len(filelist))
-    def loop(file):
-        frame = tifffile.imread(file)
-        indices = np.where(frame>0)
-        return [indices[0].min(), indices[0].max(), indices[1].min(), indices[1].max()]
-
-    n_jobs = np.minimum(cpu_count(),len(filelist))
-    results = Parallel(n_jobs=n_jobs)(delayed(loop)(file) for file in filelist)
-    results = np.asarray(results)
-    
+def file_key(file):
+    stat = os.stat(file)
+    return os.path.abspath(file), stat.st_size, stat.st_mtime_ns
+
+def get_frame_info(file):
+    with tifffile.TiffFile(file) as tif:
+        page = tif.pages[0]
+        return page.shape, page.dtype
+
+def get_fill_value(dtype):
+    # Saturated value used for the padding around the data (white, after the inversion); float data is expected in [0, 1]
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        return np.iinfo(dtype).max
+    return dtype.type(1)
+
+def get_value_range(dtype):
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        return np.iinfo(dtype).min, np.iinfo(dtype).max
+    return -np.inf, np.inf
+
+def read_roi(array, roi):
+    if roi is None:
+        return np.asarray(array)
+    y_min, y_max, x_min, x_max = roi
+    return np.asarray(array[y_min:y_max,x_min:x_max])
+
+class StackReader:
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError("Stack readers can only be sliced, use read(z) to get a frame")
+        reader = copy.copy(self)
+        reader.indices = self.indices[index]
+        return reader
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["handle"] = None
+        return state
+
+    def read(self, z, roi=None):
+        with timed("read", z) as record:
+            frame = self.read_index(self.indices[z], roi)
+            record["nbytes"] = frame.nbytes
+        return frame
+
+    def get_name(self, z):
+        return self.get_name_index(self.indices[z])
+
+    def get_key(self, z):
+        return self.get_key_index(self.indices[z])
+
+    def get_mtime(self, z):
+        return self.get_key(z)[2]/1e9
+
+class TiffDirReader(StackReader):
+    def __init__(self, filelist):
+        self.filelist = list(filelist)
+        self.indices = np.arange(len(self.filelist))
+        self.handle = None
+        self.shape, self.dtype = get_frame_info(self.filelist[0])
+        self.cache_dir = os.path.dirname(os.path.abspath(self.filelist[0]))
+
+    def read_index(self, i, roi):
+        if roi is None:
+            return tifffile.imread(self.filelist[i])
+        try:
+            return read_roi(tifffile.memmap(self.filelist[i], mode='r'), roi)
+        except ValueError:
+            return read_roi(tifffile.imread(self.filelist[i]), roi)
+
+    def get_name_index(self, i):
+        return os.path.split(self.filelist[i])[1]
+
+    def get_key_index(self, i):
+        return file_key(self.filelist[i])
+
+class MultipageTiffReader(StackReader):
+    def __init__(self, path):
+        self.path = path
+        self.handle = None
+        with tifffile.TiffFile(path) as tif:
+            self.indices = np.arange(len(tif.pages))
+            self.shape, self.dtype = tif.pages[0].shape, tif.pages[0].dtype
+        self.cache_dir = os.path.dirname(os.path.abspath(path))
+
+    def read_index(self, i, roi):
+        if self.handle is None:
+            try:
+                self.handle = tifffile.memmap(self.path, mode='r').reshape((-1,)+tuple(self.shape))
+            except ValueError:
+                self.handle = tifffile.TiffFile(self.path)
+        if isinstance(self.handle, np.ndarray):
+            return read_roi(self.handle[i], roi)
+        return read_roi(self.handle.pages[i].asarray(), roi)
+
+    def get_name_index(self, i):
+        return os.path.splitext(os.path.basename(self.path))[0]+f"_{i:05d}.tif"
+
+    def get_key_index(self, i):
+        path, size, mtime = file_key(self.path)
+        return f"{path}#{i}", size, mtime
+
+class ZarrReader(StackReader):
+    def __init__(self, path, dataset="0"):
+        self.path = path
+        self.dataset = dataset
+        self.handle = None
+        array = self.open()
+        self.indices = np.arange(array.shape[0])
+        self.shape, self.dtype = tuple(array.shape[1:]), np.dtype(array.dtype)
+        self.cache_dir = os.path.dirname(os.path.abspath(path))
+        self.mtime = self.get_array_mtime(os.path.join(path, array.path))
+
+    @staticmethod
+    def get_array_mtime(array_path):
+        # Stat the array metadata (zarr v2, v3 or N5) and its directory instead of walking every chunk
+        files = [os.path.join(array_path, name) for name in (".zarray", "zarr.json", "attributes.json")]
+        return max(os.stat(file).st_mtime_ns for file in [array_path]+files if os.path.exists(file))
+
+    def open(self):
+        node = get_zarr().open(self.path, mode='r')
+        if hasattr(node, "shape"):
+            return node
+        return node[self.dataset]
+
+    def read_index(self, i, roi):
+        if self.handle is None:
+            self.handle = self.open()
+        if roi is None:
+            return self.handle[i]
+        y_min, y_max, x_min, x_max = roi
+        return self.handle[i,y_min:y_max,x_min:x_max]
+
+    def get_name_index(self, i):
+        return f"{i:05d}.tif"
+
+    def get_key_index(self, i):
+        path = os.path.abspath(self.path)
+        return f"{path}#{self.dataset}#{i}", 0, self.mtime
+
+class RawReader(StackReader):
+    def __init__(self, path, shape, dtype, offset=0):
+        self.path = path
+        self.shape = tuple(shape[-2:])
+        self.dtype = np.dtype(dtype)
+        self.offset = offset
+        self.handle = None
+        self.n_frames = shape[0] if len(shape)==3 else (os.path.getsize(path)-offset)//(self.dtype.itemsize*int(np.prod(self.shape)))
+        self.indices = np.arange(self.n_frames)
+        self.cache_dir = os.path.dirname(os.path.abspath(path))
+
+    def read_index(self, i, roi):
+        if self.handle is None:
+            self.handle = np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.offset, shape=(self.n_frames,)+self.shape)
+        return read_roi(self.handle[i], roi)
+
+    def get_name_index(self, i):
+        return os.path.splitext(os.path.basename(self.path))[0]+f"_{i:05d}.tif"
+
+    def get_key_index(self, i):
+        path, size, mtime = file_key(self.path)
+        return f"{path}#{i}", size, mtime
+
+class CroppedReader(StackReader):
+    def __init__(self, reader, roi):
+        self.reader = get_reader(reader)
+        self.roi = clip_roi(roi, self.reader.shape)
+        self.indices = self.reader.indices
+        self.handle = None
+        self.shape = (self.roi[1]-self.roi[0], self.roi[3]-self.roi[2])
+        self.dtype = self.reader.dtype
+        self.cache_dir = self.reader.cache_dir
+
+    def read_index(self, i, roi):
+        y_min, y_max, x_min, x_max = self.roi
+        if roi is not None:
+            y_min, y_max, x_min, x_max = y_min+roi[0], y_min+roi[1], x_min+roi[2], x_min+roi[3]
+        return self.reader.read_index(i, [y_min, y_max, x_min, x_max])
+
+    def get_name_index(self, i):
+        return self.reader.get_name_index(i)
+
+    def get_key_index(self, i):
+        path, size, mtime = self.reader.get_key_index(i)
+        return f"{path}#roi{'_'.join(str(value) for value in self.roi)}", size, mtime
+
+def clip_roi(roi, shape, margin=0):
+    y_min, y_max, x_min, x_max = [int(value) for value in roi]
+    roi = [max(y_min-margin, 0), min(y_max+margin, shape[0]), max(x_min-margin, 0), min(x_max+margin, shape[1])]
+    if roi[1]<=roi[0] or roi[3]<=roi[2]:
+        raise ValueError(f"The ROI {[y_min, y_max, x_min, x_max]} does not overlap the {shape[0]}x{shape[1]} frames")
+    return roi
+
+def get_reader(stack):
+    if isinstance(stack, StackReader):
+        return stack
+    if isinstance(stack, (list, tuple)):
+        return TiffDirReader(stack)
+    if os.path.isdir(stack):
+        if os.path.exists(os.path.join(stack, ".zgroup")) or os.path.exists(os.path.join(stack, ".zarray")) or os.path.exists(os.path.join(stack, "zarr.json")):
+            return ZarrReader(stack)
+        return TiffDirReader(make_filelist(stack))
+    if stack.lower().endswith((".tif", ".tiff")):
+        return MultipageTiffReader(stack)
+    raise ValueError(f"Cannot guess the format of {stack}, use one of the StackReader classes")
+
+_context = threading.local()
+
+class Scheduler:
+    def __init__(self, n_workers=CPU_COUNT, io_limit=4, max_experiments=2):
+        self.n_workers = n_workers
+        self.io_limit = io_limit
+        self.max_experiments = max_experiments
+        self.lock = threading.Lock()
+        self.progress = {}
+
+    def report(self, experiment, stage, done, total):
+        with self.lock:
+            previous = self.progress.get((experiment, stage), -1)
+            self.progress[(experiment, stage)] = done
+            if done==total or done*10//max(total, 1)>previous*10//max(total, 1):
+                print(f"{experiment}: {stage} {done}/{total}\n", end="", flush=True)
+
+    def map(self, loop, chunks, kind="cpu", stage=None, limit=None):
+        experiment = getattr(_context, "experiment", "")
+        if stage is None:
+            stage = loop.__qualname__.split(".")[0]
+        slots = self.io_slots if kind=="io" else self.cpu_slots
+        counter = {"done": 0}
+        n_tasks = sum(len(chunk) for chunk in chunks)
+
+        def done(future, size):
+            slots.release()
+            if limit is not None:
+                limit.release()
+            with self.lock:
+                counter["done"] += size
+                n_done = counter["done"]
+            self.report(experiment, stage, n_done, n_tasks)
+
+        futures = []
+        for chunk in chunks:
+            if limit is not None:
+                limit.acquire()
+            slots.acquire()
+            future = self.executor.submit(*get_chunk_job(loop, chunk))
+            future.add_done_callback(lambda future, size=len(chunk): done(future, size))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def run(self, experiments):
+        self.executor = get_pool(self.n_workers)
+        self.io_slots = threading.BoundedSemaphore(self.io_limit)
+        self.cpu_slots = threading.BoundedSemaphore(2*self.n_workers)
+
+        def loop(name, function):
+            _context.scheduler, _context.experiment = self, name
+            try:
+                return function()
+            finally:
+                _context.scheduler, _context.experiment = None, None
+
+        with ThreadPoolExecutor(self.max_experiments) as pool:
+            futures = [pool.submit(loop, name, function) for name, function in experiments]
+            return [future.result() for future in futures]
+
+def get_n_workers():
+    scheduler = getattr(_context, "scheduler", None)
+    if scheduler is None:
+        return CPU_COUNT
+    return scheduler.n_workers
+
+def get_pool(n_workers=CPU_COUNT):
+    from joblib.externals.loky import get_reusable_executor
+    return get_reusable_executor(max_workers=n_workers, timeout=POOL_TIMEOUT, reuse=True)
+
+def run_chunk(loop, chunk):
+    return [loop(*task) for task in chunk]
+
+_records = threading.local()
+_profiler = None
+
+@contextmanager
+def timed(stage, z=None, slices=1):
+    record = {"nbytes": 0}
+    records = getattr(_records, "list", None)
+    if records is None:
+        yield record
+        return
+    start = perf_counter()
+    try:
+        yield record
+    finally:
+        records.append((stage, z, slices, record["nbytes"], perf_counter()-start))
+
+def get_peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+def run_chunk_profiled(loop, chunk, use_cprofile=False):
+    _records.list = []
+    profile, stats_path = None, None
+    if use_cprofile==True:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active in this process (e.g. a chunk running inline in a concurrent experiment)
+            profile = None
+    try:
+        results = run_chunk(loop, chunk)
+    finally:
+        if profile is not None:
+            profile.disable()
+        records, _records.list = _records.list, None
+    if profile is not None:
+        fd, stats_path = tempfile.mkstemp(prefix="fib_registration_", suffix=".prof", dir=SCRATCH_DIR)
+        os.close(fd)
+        profile.dump_stats(stats_path)
+    return results, records, get_peak_rss(), stats_path
+
+def get_chunk_job(loop, chunk):
+    if _profiler is None:
+        return run_chunk, loop, chunk
+    return run_chunk_profiled, loop, chunk, _profiler.use_cprofile
+
+class Profiler:
+    def __init__(self, save_path=None, use_cprofile=False, verbose=True):
+        self.save_path = save_path
+        self.use_cprofile = use_cprofile
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.records = []
+        self.peak_rss = 0
+        self.stats = None
+
+    def __enter__(self):
+        global _profiler
+        _profiler = self
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        global _profiler
+        _profiler = None
+        self.wall_time = perf_counter()-self.start
+        self.peak_rss = max(self.peak_rss, get_peak_rss())
+        self.report()
+
+    def add(self, result):
+        results, records, peak_rss, stats_path = result
+        experiment = getattr(_context, "experiment", None) or ""
+        with self.lock:
+            self.records.extend((experiment,)+record for record in records)
+            self.peak_rss = max(self.peak_rss, peak_rss)
+            if stats_path is not None:
+                if self.stats is None:
+                    self.stats = pstats.Stats(stats_path)
+                else:
+                    self.stats.add(stats_path)
+                os.remove(stats_path)
+        return results
+
+    def summarize(self):
+        summary = {}
+        for stage in OrderedDict.fromkeys(record[1] for record in self.records):
+            records = [record for record in self.records if record[1]==stage]
+            seconds = np.asarray([record[5] for record in records])
+            slices = sum(record[3] for record in records)
+            nbytes = sum(record[4] for record in records)
+            total = max(seconds.sum(), 1e-9)
+            summary[stage] = {"calls": len(records), "slices": slices, "total_s": seconds.sum(), "p50_ms": 1000*np.percentile(seconds, 50), "p95_ms": 1000*np.percentile(seconds, 95),
+                              "slices_per_s": slices/total, "MB": nbytes/1e6, "MB_per_s": nbytes/1e6/total}
+        return {stage: {key: float(value) for key, value in values.items()} for stage, values in summary.items()}
+
+    def report(self):
+        summary = self.summarize()
+        # Throughputs are per worker: they divide by the time spent in the stage, not by the wall time
+        lines = [f"{'stage':<12}{'slices':>8}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}{'slices/s':>10}{'MB/s':>10}"]
+        for stage, values in summary.items():
+            lines.append(f"{stage:<12}{values['slices']:>8.0f}{values['total_s']:>10.2f}{values['p50_ms']:>10.2f}{values['p95_ms']:>10.2f}{values['slices_per_s']:>10.1f}{values['MB_per_s']:>10.1f}")
+        lines.append(f"Wall time {self.wall_time:.2f}s, peak RSS {self.peak_rss/1e6:.0f}MB")
+        if self.verbose==True:
+            print("\n".join(lines))
+
+        if self.save_path is None:
+            return
+        make_dir(os.path.dirname(os.path.abspath(self.save_path)))
+        with open(self.save_path+".json", "w") as f:
+            json.dump({"wall_time": self.wall_time, "peak_rss": self.peak_rss, "stages": summary}, f, indent=2)
+        with open(self.save_path+".csv", "w") as f:
+            f.write("experiment,stage,z,slices,bytes,seconds\n")
+            for experiment, stage, z, slices, nbytes, seconds in self.records:
+                f.write(f"{experiment},{stage},{'' if z is None else z},{slices},{nbytes},{seconds!r}\n")
+        if self.stats is not None:
+            self.stats.dump_stats(self.save_path+".prof")
+
+def run_parallel(loop, tasks, kind="cpu", stage=None, chunksize=None, max_jobs=None):
+    tasks = list(tasks)
+    if len(tasks)==0:
+        return []
+    n_workers = get_n_workers()
+    if max_jobs is not None:
+        n_workers = max(1, min(n_workers, max_jobs))
+    if chunksize is None:
+        chunksize = int(np.ceil(len(tasks)/(4*n_workers)))
+    chunks = [tasks[i:i+chunksize] for i in range(0, len(tasks), chunksize)]
+    limit = None if max_jobs is None else threading.BoundedSemaphore(n_workers)
+
+    scheduler = getattr(_context, "scheduler", None)
+    if scheduler is not None:
+        results = scheduler.map(loop, chunks, kind, stage, limit)
+    elif len(chunks)==1:
+        function, *args = get_chunk_job(loop, chunks[0])
+        results = [function(*args)]
+    else:
+        pool = get_pool(get_n_workers())
+        futures = []
+        for chunk in chunks:
+            if limit is not None:
+                limit.acquire()
+            future = pool.submit(*get_chunk_job(loop, chunk))
+            if limit is not None:
+                future.add_done_callback(lambda future: limit.release())
+            futures.append(future)
+        results = [future.result() for future in futures]
+    if _profiler is not None:
+        results = [_profiler.add(result) for result in results]
+    return [result for chunk in results for result in chunk]
+
+class ScratchArray:
+    def __init__(self, shape, dtype):
+        fd, self.path = tempfile.mkstemp(prefix="fib_registration_", suffix=".raw", dir=SCRATCH_DIR)
+        os.close(fd)
+        self.shape, self.dtype = tuple(int(size) for size in shape), np.dtype(dtype)
+        self.handle = np.memmap(self.path, dtype=self.dtype, mode='w+', shape=self.shape)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["handle"] = None
+        return state
+
+    @property
+    def array(self):
+        if self.handle is None:
+            self.handle = np.memmap(self.path, dtype=self.dtype, mode='r+', shape=self.shape)
+        return self.handle
+
+    def close(self):
+        self.handle = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+STATS_CACHE_NAME = ".fib_registration_stats.npz"
+STATS_KEYS = ["bounds", "sums", "counts", "mins", "maxs", "hists"]
+HIST_BINS = 256
+
+def get_histogram(frame):
+    if np.issubdtype(frame.dtype, np.integer):
+        bits = 8*frame.dtype.itemsize - int(np.log2(HIST_BINS))
+        values = frame.ravel() >> bits if bits>0 else frame.ravel()
+        return np.bincount(values, minlength=HIST_BINS)[:HIST_BINS]
+    return np.histogram(frame, bins=HIST_BINS, range=(0, HIST_BINS))[0]
+
+def get_frame_stats(frame):
+    indices = np.where(frame>0)
+    if len(indices[0])==0:
+        bounds = [frame.shape[0], -1, frame.shape[1], -1]
+    else:
+        bounds = [indices[0].min(), indices[0].max(), indices[1].min(), indices[1].max()]
+    return {"bounds": bounds, "sums": np.sum(frame, dtype='float'), "counts": len(indices[0]),
+            "mins": frame.min(), "maxs": frame.max(), "hists": get_histogram(frame)}
+
+def load_stats_cache(cache_path):
+    if not os.path.exists(cache_path):
+        return {}
+    try:
+        with np.load(cache_path) as data:
+            cache = {key: data[key] for key in ["paths", "sizes", "mtimes"]+STATS_KEYS}
+    except (OSError, ValueError, KeyError):
+        return {}
+    return {(str(path), int(size), int(mtime)): {key: cache[key][i] for key in STATS_KEYS} for i, (path, size, mtime) in enumerate(zip(cache["paths"], cache["sizes"], cache["mtimes"]))}
+
+def save_stats_cache(cache_path, entries):
+    keys = list(entries.keys())
+    data = {"paths": np.asarray([key[0] for key in keys]), "sizes": np.asarray([key[1] for key in keys], dtype='int64'), "mtimes": np.asarray([key[2] for key in keys], dtype='int64')}
+    for name in STATS_KEYS:
+        data[name] = np.asarray([entries[key][name] for key in keys])
+    try:
+        with open(cache_path+".tmp", "wb") as f:
+            np.savez(f, **data)
+        os.replace(cache_path+".tmp", cache_path)
+    except OSError:
+        pass
+
+def scan_stack(filelist, use_cache=True):
+    reader = get_reader(filelist)
+    keys = [reader.get_key(z) for z in range(len(reader))]
+    cache_path = os.path.join(reader.cache_dir, STATS_CACHE_NAME)
+    entries = load_stats_cache(cache_path) if use_cache==True else {}
+
+    missing = [i for i, key in enumerate(keys) if key not in entries]
+    if len(missing)>0:
+        dtypes = {"bounds": 'int64', "sums": 'float64', "counts": 'int64', "mins": reader.dtype, "maxs": reader.dtype, "hists": 'int64'}
+        shapes = {"bounds": (len(missing), 4), "hists": (len(missing), HIST_BINS)}
+        results = {name: ScratchArray(shapes.get(name, (len(missing),)), dtypes[name]) for name in STATS_KEYS}
+
+        def loop(slot, z):
+            frame = reader.read(z)
+            with timed("stats", z):
+                frame_stats = get_frame_stats(frame)
+            for name in STATS_KEYS:
+                results[name].array[slot] = frame_stats[name]
+
+        try:
+            run_parallel(loop, enumerate(missing), kind="io")
+            arrays = {name: np.array(results[name].array) for name in STATS_KEYS}
+        finally:
+            for result in results.values():
+                result.close()
+        for slot, i in enumerate(missing):
+            entries[keys[i]] = {name: arrays[name][slot] for name in STATS_KEYS}
+        if use_cache==True:
+            save_stats_cache(cache_path, entries)
+
+    stats = {}
+    stats["shape"] = reader.shape
+    for name in STATS_KEYS:
+        stats[name] = np.asarray([entries[key][name] for key in keys])
+    return stats
+
+def bounds_from_stats(stats, padding):
+    results, frame_shape = stats["bounds"], stats["shape"]
     bounds = [min(results[:,0]), max(results[:,1]), min(results[:,2]), max(results[:,3])]
     bounds = [max(bounds[0]-padding, 0), min(bounds[1]+padding, frame_shape[0]), max(bounds[2]-padding, 0), min(bounds[3]+padding, frame_shape[1])]
     return bounds
 
+def means_from_stats(stats, means_smoothing):
+    # Empty slices have no mean, smooth over the valid ones only like StreamingMeans does
+    valid = stats["counts"]>0
+    means = np.divide(stats["sums"], stats["counts"], out=np.zeros(len(valid)), where=valid)
+    weights = gaussian_filter(valid.astype(float), means_smoothing)
+    smoothed = gaussian_filter(means, means_smoothing)
+    fallback = means[valid].mean() if valid.any() else 0.
+    return np.divide(smoothed, weights, out=np.full(len(valid), fallback), where=weights>0)
+
+def get_bounds(filelist, padding):
+    stats = scan_stack(filelist)
+    return bounds_from_stats(stats, padding)
+
 def get_means(filelist, means_smoothing):
+    stats = scan_stack(filelist)
+    return means_from_stats(stats, means_smoothing)
 
-    def loop(file):
-        frame = tifffile.imread(file).astype("float")
-        mean = np.sum(frame)/np.sum(frame>0)
-        return mean
+def get_masked_mean(frame):
+    count = np.count_nonzero(frame>0)
+    return np.sum(frame, dtype='float')/count if count>0 else np.nan
 
-    n_jobs = np.minimum(CPU_COUNT,len(filelist))
-    means = Parallel(n_jobs=n_jobs)(delayed(loop)(file) for file in filelist)
-    means = np.asarray(means)
-    means = gaussian_filter(means, means_smoothing)
-    return means
+class StreamingMeans:
+    def __init__(self, reader, roi, means_smoothing, lookahead=None):
+        # Same kernel as gaussian_filter, so with a full lookahead the smoothed means match the global mode
+        self.reader, self.roi = reader, roi
+        self.radius = int(4*means_smoothing+0.5)
+        self.lookahead = self.radius if lookahead is None else min(lookahead, self.radius)
+        offsets = np.arange(-self.radius, self.radius+1)
+        self.weights = np.exp(-0.5*offsets**2/max(means_smoothing, 1e-9)**2)
+        self.frames, self.means = OrderedDict(), {}
 
-def crop_data(filelist, save_path, padding):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["frames"], state["means"] = OrderedDict(), {}
+        return state
 
-    bounds = get_bounds(filelist, padding)
+    def read(self, z):
+        if z in self.frames:
+            return self.frames[z]
+        frame = self.reader.read(z, self.roi)
+        self.means[z] = get_masked_mean(frame)
+        self.frames[z] = frame
+        if len(self.frames)>self.lookahead+1:
+            self.frames.popitem(last=False)
+        return frame
 
-    make_dir(save_path)
+    def get_mean(self, z):
+        if z not in self.means:
+            self.read(z)
+        return self.means[z]
 
-    def loop(file):
-        frame = tifffile.imread(file)[bounds[0]:bounds[1],bounds[2]:bounds[3]]
-        filename = os.path.split(file)[1]
-        tifffile.imwrite(os.path.join(save_path, filename), frame)
+    def get_smoothed_mean(self, z):
+        n = len(self.reader)
+        indices = np.arange(z-self.radius, z+self.radius+1)
+        # Mirror at the stack ends like gaussian_filter's "reflect" mode
+        period = 2*n
+        indices = np.mod(indices, period)
+        indices = np.where(indices>=n, period-1-indices, indices)
+        keep = indices<=z+self.lookahead
+        means = np.asarray([self.get_mean(i) for i in indices[keep]])
+        weights = self.weights[keep]
+        valid = ~np.isnan(means)
+        return np.sum(weights[valid]*means[valid])/np.sum(weights[valid])
 
-    n_jobs = np.minimum(CPU_COUNT,len(filelist))
-    _ = Parallel(n_jobs=n_jobs)(delayed(loop)(file) for file in filelist)
+    def get_reference_mean(self):
+        means = np.asarray([self.get_mean(z) for z in range(min(self.lookahead+1, len(self.reader)))])
+        return np.nanmean(means)
 
-def normalize_data(filelist, save_path, means_smoothing):
-    make_dir(save_path)
+def get_norm_lut(dtype, offset, invert=False):
+    # 8 and 16-bit frames are mapped through a table of all their values instead of being converted to float
+    high = np.iinfo(dtype).max
+    lut = np.clip(np.rint(np.arange(high+1, dtype='float32')+offset), 0, high).astype(dtype)
+    lut[0] = 0
+    if invert==True:
+        lut = high-lut
+    return lut
 
-    means = get_means(filelist, means_smoothing)
-    total_mean = means.mean()
+def normalize_frame(frame, offset):
+    low, high = get_value_range(frame.dtype)
+    zero_mask = frame<=0
+    normalized = frame.astype('float32')+offset
+    if np.issubdtype(frame.dtype, np.integer):
+        normalized = np.rint(normalized)
+    normalized = np.clip(normalized, max(low, 0), high)
+    normalized[zero_mask] = 0
+    return normalized.astype(frame.dtype)
 
-    def loop(file, curr_mean):
-        frame = tifffile.imread(file).astype("float")
-        zero_mask = frame <= 0
-        frame = frame - curr_mean + total_mean
-        frame[zero_mask]=0
-        frame = frame.astype("uint8")
-        filename = os.path.split(file)[1]
-        tifffile.imwrite(os.path.join(save_path, filename), frame)
+def invert_frame(frame):
+    return get_fill_value(frame.dtype)-frame
 
-    n_jobs = np.minimum(CPU_COUNT,len(filelist))
-    _ = Parallel(n_jobs=n_jobs)(delayed(loop)(file, curr_mean) for file, curr_mean in zip(filelist, means))
+def crop_data(filelist, save_path, padding, writer=None):
+    preprocess_data(filelist, save_path, 1, 0, 0, padding, None, writer)
 
-def invert_data(filelist, save_path):
-    make_dir(save_path)
+def normalize_data(filelist, save_path, means_smoothing, writer=None, norm_mode=NORM_MODE_DEFAULT, lookahead=None):
+    preprocess_data(filelist, save_path, 0, 1, 0, None, means_smoothing, writer, norm_mode, lookahead)
+
+def invert_data(filelist, save_path, writer=None):
+    preprocess_data(filelist, save_path, 0, 0, 1, None, None, writer)
+
+def preprocess_data(filelist, save_path, crop, norm, invert, padding, means_smoothing, writer=None, norm_mode=NORM_MODE_DEFAULT, lookahead=None):
+    if writer is None:
+        writer = TiffWriter(save_path)
+    if norm_mode not in ["global", "streaming"]:
+        raise ValueError("norm_mode must be 'global' or 'streaming'")
+
+    reader = get_reader(filelist)
+    shape, dtype = reader.shape, reader.dtype
+    bounds, means, streaming = None, None, None
+    if crop==1 or (norm==1 and norm_mode=="global"):
+        stats = scan_stack(reader)
+        if crop==1:
+            bounds = bounds_from_stats(stats, padding)
+            shape = (bounds[1]-bounds[0], bounds[3]-bounds[2])
+    if norm==1:
+        if norm_mode=="global":
+            means = means_from_stats(stats, means_smoothing)
+            total_mean = means.mean()
+        else:
+            # Each slice only waits for the next lookahead slices, and the level is set by the first ones
+            streaming = StreamingMeans(reader, bounds, means_smoothing, lookahead)
+            total_mean = streaming.get_reference_mean()
+
+    use_lut = dtype.kind=="u" and dtype.itemsize<=2
+
+    def get_frame(z):
+        frame = reader.read(z, bounds) if streaming is None else streaming.read(z)
+        with timed("preprocess", z):
+            if norm==1:
+                offset = total_mean-(means[z] if streaming is None else streaming.get_smoothed_mean(z))
+                if use_lut==True:
+                    return get_norm_lut(dtype, offset, invert==1)[frame]
+                frame = normalize_frame(frame, offset)
+            if invert==1:
+                frame = invert_frame(frame)
+        return frame
 
-    def loop(file):
-        frame = tifffile.imread(file)
-        frame = 255-frame
-        filename = os.path.split(file)[1]
-        tifffile.imwrite(os.path.join(save_path, filename), frame)
+    write_stack(writer, reader, shape, dtype, get_frame)
 
-    n_jobs = np.minimum(CPU_COUNT,len(filelist))
-    _ = Parallel(n_jobs=n_jobs)(delayed(loop)(file) for file in filelist)
+def largest_rectangle(mask):
+    n_rows, n_cols = mask.shape
+    rows = np.arange(n_rows)
 
-def get_range(array):
-    array = array.astype('float')
-    return np.max(array)-np.min(array)
+    heights = np.zeros(mask.shape, dtype='int32')
+    heights[0] = mask[0]
+    for r in range(1, n_rows):
+        heights[r] = (heights[r-1]+1)*mask[r]
+
+    def get_limits(columns, start):
+        limits = np.empty(mask.shape, dtype='int64')
+        for c in columns:
+            limit = np.full(n_rows, c-start)
+            active = rows[(limit>=0) & (limit<n_cols)]
+            active = active[heights[active, limit[active]] >= heights[active, c]]
+            while len(active)>0:
+                limit[active] = limits[active, limit[active]]
+                active = active[(limit[active]>=0) & (limit[active]<n_cols)]
+                active = active[heights[active, limit[active]] >= heights[active, c]]
+            limits[:,c] = limit
+        return limits
+
+    left = get_limits(range(n_cols), 1)
+    right = get_limits(range(n_cols-1, -1, -1), -1)
+
+    areas = heights*(right-left-1)
+    r, c = np.unravel_index(np.argmax(areas), areas.shape)
+    if areas[r, c]==0:
+        return None
+    return r-heights[r, c]+1, r, left[r, c]+1, right[r, c]-1
+
+def grow_rectangle(mask, y_min, y_max, x_min, x_max):
+
+    def count_full(lines):
+        if lines.all():
+            return len(lines)
+        return np.argmin(lines)
+
+    grown = True
+    while grown==True:
+        up = count_full(mask[:y_min, x_min:x_max+1].all(axis=1)[::-1])
+        y_min -= up
+        down = count_full(mask[y_max+1:, x_min:x_max+1].all(axis=1))
+        y_max += down
+        left = count_full(mask[y_min:y_max+1, :x_min].all(axis=0)[::-1])
+        x_min -= left
+        right = count_full(mask[y_min:y_max+1, x_max+1:].all(axis=0))
+        x_max += right
+        grown = up+down+left+right>0
+
+    return y_min, y_max, x_min, x_max
 
 def get_inner_rectangle(mask, step):
-    up, down, left, right = False, False, False, False
+    mask = mask.astype('bool')
+    step = int(max(1, min(step, min(mask.shape)//16)))
 
-    while min([up,down,left,right])==0:
-        indices = np.where(mask==1)
-        y_min, y_max, x_min, x_max = indices[0].min(), indices[0].max(), indices[1].min(), indices[1].max()
+    rectangle = None
+    while rectangle is None and step>=1:
+        n_rows, n_cols = mask.shape[0]//step, mask.shape[1]//step
+        coarse_mask = mask[:n_rows*step,:n_cols*step].reshape(n_rows, step, n_cols, step).all(axis=(1,3))
+        rectangle = largest_rectangle(coarse_mask)
+        if rectangle is None:
+            step = step//2
 
-        new_mask = mask.copy()
+    if rectangle is None:
+        return 0, mask.shape[0]-1, 0, mask.shape[1]-1
 
-        line_up = mask[y_min,x_min:x_max]
-        if get_range(line_up)==0:
-            up = True
-        else:
-            new_mask[:y_min+step,:]=0
+    y_min, y_max, x_min, x_max = rectangle
+    y_min, y_max, x_min, x_max = y_min*step, (y_max+1)*step-1, x_min*step, (x_max+1)*step-1
+        
+    return grow_rectangle(mask, y_min, y_max, x_min, x_max)
 
-        line_down = mask[y_max,x_min:x_max]
-        if get_range(line_down)==0:
-            down = True
-        else:
-            new_mask[y_max-step:,:]=0
+def get_spectrum(frame, fft_workers=1):
+    return rfft2(frame, workers=fft_workers)
 
-        line_left = mask[y_min:y_max,x_min]
-        if get_range(line_left)==0:
-            left = True
-        else:
-            new_mask[:,:x_min+step]=0
+def get_spectrum_weights(n_cols):
+    weights = np.full(n_cols//2+1, 2.0)
+    weights[0] = 1
+    if n_cols%2==0:
+        weights[-1] = 1
+    return weights
+
+def upsampled_dft(image_product, shape, region_size, upsample_factor, offsets):
+    row_kernel = np.exp(2j*np.pi*(np.arange(region_size)-offsets[0])[:,None]*fftfreq(shape[0], upsample_factor)[None,:])
+    col_kernel = np.exp(2j*np.pi*(np.arange(region_size)-offsets[1])[:,None]*rfftfreq(shape[1], upsample_factor)[None,:])
+    col_kernel = col_kernel*get_spectrum_weights(shape[1])[None,:]
+    return np.real(row_kernel @ image_product @ col_kernel.T)
+
+def get_PCC_spectra(reference_spectrum, moving_spectrum, shape, upsample_factor, fft_workers=1):
+    shape = np.asarray(shape)
+    image_product = reference_spectrum*moving_spectrum.conj()
+    cross_correlation = irfft2(image_product, s=tuple(shape), workers=fft_workers)
+
+    maxima = np.unravel_index(np.argmax(np.abs(cross_correlation)), cross_correlation.shape)
+    CCmax = float(cross_correlation[maxima])
+    translation = np.asarray(maxima, dtype='float')
+    midpoint = np.trunc(shape/2)
+    translation[translation>midpoint] -= shape[translation>midpoint]
+
+    weights = get_spectrum_weights(shape[1])[None,:]
+    reference_amp = np.sum(weights*np.abs(reference_spectrum)**2)
+    moving_amp = np.sum(weights*np.abs(moving_spectrum)**2)
+
+    if upsample_factor>1:
+        translation = np.round(translation*upsample_factor)/upsample_factor
+        region_size = np.ceil(upsample_factor*1.5)
+        dftshift = np.trunc(region_size/2)
+        cross_correlation = upsampled_dft(image_product, shape, int(region_size), upsample_factor, dftshift-translation*upsample_factor)
+        maxima = np.unravel_index(np.argmax(np.abs(cross_correlation)), cross_correlation.shape)
+        CCmax = cross_correlation[maxima]
+        translation += (np.asarray(maxima)-dftshift)/upsample_factor
+    else:
+        reference_amp /= shape.prod()
+        moving_amp /= shape.prod()
 
-        line_right = mask[y_min:y_max,x_max]
-        if get_range(line_right)==0:
-            right = True
+    translation[shape==1] = 0
+    error = np.sqrt(np.abs(1-CCmax**2/(reference_amp*moving_amp)))
+    phasediff = np.arctan2(0, CCmax)
+    return translation, error, phasediff
+
+def make_spectrum_cache(load, size):
+    cache = OrderedDict()
+
+    def get(z):
+        if z in cache:
+            cache.move_to_end(z)
         else:
-            new_mask[:,x_max-step:]=0
-            
-        mask = new_mask.copy()
+            cache[z] = load(z)
+            if len(cache)>size:
+                cache.popitem(last=False)
+        return cache[z]
 
-    indices = np.where(mask==1)
-    y_min, y_max, x_min, x_max = indices[0].min(), indices[0].max(), indices[1].min(), indices[1].max()
-        
-    return y_min, y_max, x_min, x_max
+    return get
 
-def get_PCC(reference_frame, moving_frame, bounds, upsample_factor):
+def get_PCC_metrics(reference_frame, moving_frame, bounds, upsample_factor, fft_workers=1):
     y_min, y_max, x_min, x_max = bounds
-    translation = phase_cross_correlation(reference_frame[y_min:y_max,x_min:x_max], moving_frame[y_min:y_max,x_min:x_max], upsample_factor=upsample_factor, normalization=None)[0]
+    reference_frame, moving_frame = reference_frame[y_min:y_max,x_min:x_max], moving_frame[y_min:y_max,x_min:x_max]
+    reference_spectrum, moving_spectrum = get_spectrum(reference_frame, fft_workers), get_spectrum(moving_frame, fft_workers)
+    return get_PCC_spectra(reference_spectrum, moving_spectrum, reference_frame.shape, upsample_factor, fft_workers)
+
+def get_PCC(reference_frame, moving_frame, bounds, upsample_factor, fft_workers=1):
+    translation = get_PCC_metrics(reference_frame, moving_frame, bounds, upsample_factor, fft_workers)[0]
     return translation
 
-def get_translation(filelist, upsample_factor, mask_crop_step):
+def downsample(frame, factor):
+    n_rows, n_cols = frame.shape[0]//factor, frame.shape[1]//factor
+    return frame[:n_rows*factor,:n_cols*factor].reshape(n_rows, factor, n_cols, factor).mean(axis=(1,3))
+
+def get_PCC_pyramid(reference_frame, moving_frame, bounds, upsample_factor, pyramid, fft_workers=1, coarse_spectra=None, fine_window=PYRAMID_WINDOW_DEFAULT):
+    y_min, y_max, x_min, x_max = bounds
+    height, width = y_max-y_min, x_max-x_min
+    if pyramid<=1 or min(height, width)<4*pyramid:
+        return get_PCC_metrics(reference_frame, moving_frame, bounds, upsample_factor, fft_workers)
+
+    if coarse_spectra is None:
+        reference_coarse = downsample(reference_frame[y_min:y_max,x_min:x_max], pyramid)
+        moving_coarse = downsample(moving_frame[y_min:y_max,x_min:x_max], pyramid)
+        coarse_spectra = get_spectrum(reference_coarse, fft_workers), get_spectrum(moving_coarse, fft_workers)
+    coarse_shape = (height//pyramid, width//pyramid)
+    coarse_translation = get_PCC_spectra(coarse_spectra[0], coarse_spectra[1], coarse_shape, 1, fft_workers)[0]
+    offset = np.round(coarse_translation*pyramid).astype('int')
 
-    dx = []
-    dx.append([0,0])
+    # The fine step runs on a fine_window square of the overlap (the whole overlap if 0 or None): smaller windows are faster but noisier
+    overlap = np.asarray([height, width])-np.abs(offset)
+    window = overlap if not fine_window else np.minimum(max(fine_window, 32), overlap)
+    # Multiples of 64 keep the FFT sizes fast
+    window = np.where(window>=64, window//64*64, window)
+    low = np.asarray([y_min, x_min]) + np.clip(offset, 0, None)
+    high = np.asarray([y_max, x_max]) + np.clip(offset, None, 0) - window
+    if np.any(high<low):
+        return get_PCC_metrics(reference_frame, moving_frame, bounds, upsample_factor, fft_workers)
+    start = np.clip((np.asarray([y_min+y_max, x_min+x_max])-window)//2, low, high)
+    stop = start+window
 
-    def loop(z):
-        reference_frame, moving_frame = tifffile.imread(filelist[z-1]).astype('float'), tifffile.imread(filelist[z]).astype('float')
-        reference_mask, moving_mask = reference_frame<255, moving_frame<255
+    reference_window = reference_frame[start[0]:stop[0],start[1]:stop[1]]
+    moving_window = moving_frame[start[0]-offset[0]:stop[0]-offset[0],start[1]-offset[1]:stop[1]-offset[1]]
+    fine_translation, error, phasediff = get_PCC_metrics(reference_window, moving_window, [0, window[0], 0, window[1]], upsample_factor, fft_workers)
+    return offset + fine_translation, error, phasediff
+
+def get_shared_window(filelist, mask_crop_step, n_samples=16):
+    reader = get_reader(filelist)
+    if n_samples is None:
+        n_samples = len(reader)
+    samples = np.unique(np.linspace(0, len(reader)-1, min(n_samples, len(reader))).astype('int'))
+
+    groups = [samples[z_start:z_end] for z_start, z_end in split_blocks(len(samples), min(get_n_workers(), len(samples)))]
+    with ScratchArray((len(groups),)+tuple(reader.shape), 'bool') as masks:
+
+        def loop(slot, group):
+            mask = read_mask(reader, group[0])
+            for z in group[1:]:
+                mask &= read_mask(reader, z)
+            masks.array[slot] = mask
+
+        run_parallel(loop, enumerate(groups), kind="io", chunksize=1)
+        mask = np.logical_and.reduce(masks.array, axis=0)
+    y_min, y_max, x_min, x_max = get_inner_rectangle(mask, mask_crop_step)
+    return y_min, y_max, x_min, x_max
+
+def split_blocks(n, n_blocks):
+    edges = np.linspace(0, n, n_blocks+1).astype('int')
+    return [(edges[i], edges[i+1]) for i in range(n_blocks) if edges[i+1]>edges[i]]
+
+def read_mask(reader, z):
+    frame = reader.read(z)
+    return frame<get_fill_value(frame.dtype)
+
+def read_frame(reader, z):
+    frame = reader.read(z)
+    return frame.astype('float32'), frame<get_fill_value(frame.dtype)
+
+def get_pair_translation(reference_frame, reference_mask, moving_frame, moving_mask, upsample_factor, mask_crop_step, pyramid=1, fft_workers=1, pyramid_window=PYRAMID_WINDOW_DEFAULT):
+    with timed("mask"):
         mask = reference_mask*moving_mask
         y_min, y_max, x_min, x_max = get_inner_rectangle(mask, mask_crop_step)
-        
-        translation = get_PCC(reference_frame, moving_frame, [y_min, y_max, x_min, x_max], upsample_factor)
+        area = (y_max-y_min)*(x_max-x_min)/mask.size
+    with timed("correlation"):
+        return (*get_PCC_pyramid(reference_frame, moving_frame, [y_min, y_max, x_min, x_max], upsample_factor, pyramid, fft_workers, fine_window=pyramid_window), area)
 
-        return translation
+def get_pair_flags(pairs):
+    flags = np.zeros(len(pairs), dtype='int')
+    if len(pairs)==0:
+        return flags
+    errors = pairs[:,2]
+    median = np.median(errors)
+    deviation = 1.4826*np.median(np.abs(errors-median))
+    # The error scale depends on noise and texture, so the floor follows the median rather than a fixed value
+    flags[errors>median+max(QC_DEVIATIONS*deviation, QC_MIN_ERROR_RATIO*median)] |= QC_ERROR
+    flags[pairs[:,4]<QC_MIN_AREA] |= QC_AREA
+    flags[get_shift_deviation(pairs)>get_shift_threshold(pairs)] |= QC_SHIFT
+    return flags
 
-    n_jobs = np.minimum(CPU_COUNT,len(filelist)-1)
-    results = Parallel(n_jobs=n_jobs)(delayed(loop)(z) for z in range(1,len(filelist)))
-    
-    dx.extend(results)
-    dx = np.cumsum(np.asarray(dx),axis=0)
+def get_rolling_shift(pairs):
+    return median_filter(pairs[:,:2], size=(QC_WINDOW, 1), mode='nearest')
+
+def get_shift_deviation(pairs):
+    return np.linalg.norm(pairs[:,:2]-get_rolling_shift(pairs), axis=1)
+
+def get_shift_threshold(pairs):
+    return max(QC_DEVIATIONS*1.4826*np.median(get_shift_deviation(pairs)), QC_MIN_SHIFT)
+
+def combine_pairs(long_pair, short_pair):
+    return np.asarray([*(long_pair[:2]-short_pair[:2]), max(long_pair[2], short_pair[2]), long_pair[3], min(long_pair[4], short_pair[4])])
+
+def refine_pairs(reader, pairs, flags, upsample_factor, mask_crop_step):
+    # Flagged pairs are re-estimated on the full frames with a finer rectangle search and upsampling,
+    # and through their neighbours (z-2 and z+1) in case one of the two slices is bad
+    def load(z):
+        return read_frame(reader, z)
+
+    def estimate(frames, z_reference, z):
+        reference_frame, reference_mask = frames(z_reference)
+        moving_frame, moving_mask = frames(z)
+        translation, error, phasediff, area = get_pair_translation(reference_frame, reference_mask, moving_frame, moving_mask, 2*upsample_factor, max(mask_crop_step//4, 1))
+        return np.asarray([*translation, error, phasediff, area])
 
+    def loop(i):
+        frames = make_spectrum_cache(load, 4)
+        z = i+1
+        candidates, bridge = [estimate(frames, z-1, z)], None
+        if z>=2:
+            candidates.append(combine_pairs(estimate(frames, z-2, z), estimate(frames, z-2, z-1)))
+        if z+1<len(reader):
+            bridge = estimate(frames, z-1, z+1)
+            candidates.append(combine_pairs(bridge, estimate(frames, z, z+1)))
+        return np.asarray(candidates), bridge
+
+    flagged = np.flatnonzero(flags)
+    results = dict(zip(flagged, run_parallel(loop, [(i,) for i in flagged])))
+
+    refined = pairs.copy()
+    threshold = get_shift_threshold(pairs)
+    rolling = get_rolling_shift(pairs)
+    unresolved = []
+    for i, (candidates, bridge) in results.items():
+        deviation = np.linalg.norm(candidates[:,:2]-rolling[i], axis=1)
+        plausible = candidates[deviation<=threshold]
+        if len(plausible)>0:
+            refined[i,:5] = plausible[np.argmin(plausible[:,2])]
+        else:
+            refined[i,:5] = candidates[np.argmin(candidates[:,2])]
+            unresolved.append(i)
+
+    # Two consecutive bad pairs usually mean one bad slice, which is bridged by correlating its two neighbours
+    for i in unresolved:
+        bridge = results[i][1]
+        if i+1 in unresolved and bridge is not None and np.linalg.norm(bridge[:2]-rolling[i]-rolling[i+1])<=2*threshold:
+            refined[i,:5] = refined[i+1,:5] = [*(bridge[:2]/2), *bridge[2:]]
+    return refined
+
+def get_pair_indices(n, skip):
+    return [(z-k, z) for z in range(1, n) for k in range(1, min(skip, z)+1)]
+
+def solve_translation(n, indices, measurements, errors, outlier_threshold=3, min_residual=0.5, n_iterations=3):
+    indices = np.asarray(indices).reshape(-1, 2)
+    rows = np.repeat(np.arange(len(indices)), 2)
+    columns = indices.ravel()-1
+    values = np.tile([-1.0, 1.0], len(indices))
+    keep = columns>=0
+    A = coo_matrix((values[keep], (rows[keep], columns[keep])), shape=(len(indices), n-1)).tocsr()
+
+    errors = np.asarray(errors, dtype='float')
+    weights = 1/np.maximum(errors, 1e-3)**2
+    median = np.median(errors)
+    deviation = 1.4826*np.median(np.abs(errors-median))
+    inliers = errors<=median+outlier_threshold*max(deviation, 1e-3)
+
+    for _ in range(n_iterations):
+        # Rejected pairs keep a tiny weight so that every slice stays connected
+        W = weights*np.where(inliers, 1, 1e-6)
+        AtW = A.T.multiply(W[None,:]).tocsc()
+        solution = spsolve((AtW @ A).tocsc(), AtW @ measurements).reshape(n-1, 2)
+        residuals = np.linalg.norm(A @ solution-measurements, axis=1)
+        deviation = 1.4826*np.median(residuals[inliers]) if np.any(inliers) else 0
+        updated = inliers & (residuals<=max(outlier_threshold*deviation, min_residual))
+        if np.array_equal(updated, inliers):
+            break
+        inliers = updated
+
+    dx = np.zeros((n, 2))
+    dx[1:] = solution
+    return dx, inliers
+
+def get_translation(filelist, upsample_factor, mask_crop_step, pyramid=1, streaming=True, window=None, fft_workers=1, return_pairs=False, skip=1, refine=True, pyramid_window=PYRAMID_WINDOW_DEFAULT):
+
+    reader = get_reader(filelist)
+    if window=="shared":
+        window = get_shared_window(reader, mask_crop_step)
+
+    def load(z):
+        return read_frame(reader, z)
+
+    def load_spectrum(z):
+        frame = reader.read(z, window).astype('float32')
+        with timed("spectrum", z):
+            if pyramid>1:
+                return frame, get_spectrum(downsample(frame, pyramid), fft_workers)
+            return frame, get_spectrum(frame, fft_workers)
+
+    def loop(z_reference, z):
+        reference_frame, reference_mask = load(z_reference)
+        moving_frame, moving_mask = load(z)
+        return get_pair_translation(reference_frame, reference_mask, moving_frame, moving_mask, upsample_factor, mask_crop_step, pyramid, fft_workers, pyramid_window)
+
+    def loop_block(z_start, z_end):
+        translations = []
+        get_cached_frame = make_spectrum_cache(load, skip+1)
+        for z in range(z_start, z_end):
+            # The references are fetched before z, so that z only evicts the oldest slice, which is no longer needed
+            references = [get_cached_frame(z-k) for k in range(1, min(skip, z)+1)]
+            moving_frame, moving_mask = get_cached_frame(z)
+            # Frames are read once, but each pair correlates its own rectangle, so its spectra cannot be reused
+            for reference_frame, reference_mask in references:
+                translations.append(get_pair_translation(reference_frame, reference_mask, moving_frame, moving_mask, upsample_factor, mask_crop_step, pyramid, fft_workers, pyramid_window))
+        return translations
+
+    def loop_block_window(z_start, z_end):
+        translations = []
+        window_shape = (window[1]-window[0], window[3]-window[2])
+        area = window_shape[0]*window_shape[1]/np.prod(reader.shape)
+        get_cached_spectrum = make_spectrum_cache(load_spectrum, skip+1)
+        for z in range(z_start, z_end):
+            references = [get_cached_spectrum(z-k) for k in range(1, min(skip, z)+1)]
+            moving_frame, moving_spectrum = get_cached_spectrum(z)
+            for reference_frame, reference_spectrum in references:
+                with timed("correlation", z):
+                    if pyramid>1:
+                        translation = get_PCC_pyramid(reference_frame, moving_frame, [0, window_shape[0], 0, window_shape[1]], upsample_factor, pyramid, fft_workers, (reference_spectrum, moving_spectrum), pyramid_window)
+                    else:
+                        translation = get_PCC_spectra(reference_spectrum, moving_spectrum, window_shape, upsample_factor, fft_workers)
+                translations.append((*translation, area))
+        return translations
+
+    n_jobs = np.minimum(get_n_workers(),len(reader)-1)
+    indices = get_pair_indices(len(reader), skip)
+    if window is not None:
+        blocks = split_blocks(len(reader)-1, n_jobs)
+        results = run_parallel(loop_block_window, [(z_start+1, z_end+1) for z_start, z_end in blocks])
+        results = [translation for block in results for translation in block]
+    elif streaming==True:
+        blocks = split_blocks(len(reader)-1, n_jobs)
+        results = run_parallel(loop_block, [(z_start+1, z_end+1) for z_start, z_end in blocks])
+        results = [translation for block in results for translation in block]
+    else:
+        results = run_parallel(loop, indices)
+
+    measurements = np.asarray([[translation[0], translation[1], error, phasediff, area] for translation, error, phasediff, area in results]).reshape(-1, 5)
+    adjacent = np.asarray([z-z_reference==1 for z_reference, z in indices], dtype='bool')
+    pairs = np.concatenate([measurements[adjacent], np.zeros((np.sum(adjacent), 1))], axis=1)
+
+    flags = get_pair_flags(pairs)
+    if np.any(flags):
+        message = f"QC: {np.count_nonzero(flags)}/{len(flags)} pairs flagged ({np.count_nonzero(flags&QC_ERROR)} error, {np.count_nonzero(flags&QC_AREA)} area, {np.count_nonzero(flags&QC_SHIFT)} shift)"
+        if refine==True:
+            pairs = refine_pairs(reader, pairs, flags, upsample_factor, mask_crop_step)
+            measurements[adjacent] = pairs[:,:5]
+            flags = np.where(flags>0, get_pair_flags(pairs)|QC_REFINED, 0)
+            message += f", re-estimated, {np.count_nonzero(flags&~QC_REFINED)} still flagged"
+        print(message)
+    pairs[:,5] = flags
+    if skip>1 and len(reader)>2:
+        dx, inliers = solve_translation(len(reader), indices, measurements[:,:2], measurements[:,2])
+        print(f"Global drift solve: {np.sum(~inliers)}/{len(inliers)} pairs rejected as outliers")
+    else:
+        dx = np.zeros((len(reader), 2))
+        dx[1:] = pairs[:,:2]
+        dx = np.cumsum(dx,axis=0)
+
+    if return_pairs==True:
+        return dx, pairs
     return dx
 
+TRANSLATION_NAME = "translation.csv"
+TRANSLATION_VERSION = 2
+TRANSLATION_HEADER = "# fib_registration translation v"
+PAIR_COLUMNS = ["pair_y", "pair_x", "error", "phasediff", "area", "flags"]
+PAIR_DEFAULTS = {"area": np.nan, "flags": 0}
+
+def slice_hash(reader, z):
+    _, size, mtime = reader.get_key(z)
+    return hashlib.sha1(f"{reader.get_name(z)}:{size}:{mtime}".encode()).hexdigest()[:16]
+
+def write_translation_rows(f, reader, translation, pairs, z_start=0):
+    for z, (pair, dx) in enumerate(zip(pairs, translation)):
+        values = ",".join(repr(float(value)) for value in [*pair, *dx])
+        f.write(f"{z_start+z},{reader.get_name(z)},{slice_hash(reader, z)},{values}\n")
+
+def save_translation(path, filelist, translation, pairs, params):
+    reader = get_reader(filelist)
+    pairs = np.concatenate([np.zeros((1, len(PAIR_COLUMNS))), pairs], axis=0)
+    with open(path+".tmp", "w") as f:
+        f.write(f"{TRANSLATION_HEADER}{TRANSLATION_VERSION}\n")
+        f.write(f"# params: {json.dumps(params)}\n")
+        f.write(",".join(["index", "filename", "hash"]+PAIR_COLUMNS+["y", "x"])+"\n")
+        write_translation_rows(f, reader, translation, pairs)
+    os.replace(path+".tmp", path)
+
+def append_translation(path, filelist, translation, pairs, z_start):
+    with open(path, "a") as f:
+        write_translation_rows(f, get_reader(filelist), translation, pairs, z_start)
+
+def load_translation(path, filelist=None):
+    with open(path) as f:
+        version = f.readline().strip()
+        params = f.readline().strip()
+        header = f.readline().strip().split(",")
+        lines = f.read().splitlines()
+    if not version.startswith(TRANSLATION_HEADER) or not version[len(TRANSLATION_HEADER):].isdigit() or int(version[len(TRANSLATION_HEADER):])>TRANSLATION_VERSION:
+        raise ValueError(f"{path} is not a translation file of version {TRANSLATION_VERSION} or older")
+
+    rows = [line.split(",") for line in lines if line!=""]
+    columns = {name: i for i, name in enumerate(header)}
+    def get_column(name, rows):
+        if name not in columns:
+            return [PAIR_DEFAULTS[name]]*len(rows)
+        return [float(row[columns[name]]) for row in rows]
+
+    saved = {}
+    saved["version"] = int(version[len(TRANSLATION_HEADER):])
+    saved["params"] = json.loads(params[len("# params: "):])
+    saved["filenames"] = [row[1] for row in rows]
+    saved["hashes"] = [row[2] for row in rows]
+    saved["pairs"] = np.asarray([get_column(name, rows[1:]) for name in PAIR_COLUMNS]).T.reshape(-1, len(PAIR_COLUMNS))
+    saved["translation"] = np.asarray([get_column(name, rows) for name in ["y", "x"]]).T.reshape(-1, 2)
+
+    if filelist is not None:
+        reader = get_reader(filelist)
+        if len(reader)!=len(rows):
+            raise ValueError(f"{path} has {len(rows)} slices but the stack has {len(reader)}")
+        changed = [z for z, (filename, saved_hash) in enumerate(zip(saved["filenames"], saved["hashes"])) if reader.get_name(z)==filename and slice_hash(reader, z)!=saved_hash]
+        if len(changed)>0:
+            print(f"Warning: {len(changed)} slices changed since {path} was saved")
+        saved["changed"] = changed
+    return saved
+
 def pad_from_translation(translation):
     dx_before = np.clip(-translation, 0, None)
     dx_after = np.clip(translation, 0, None)
@@ -189,38 +1223,668 @@ def pad_from_translation(translation):
 
     return ((before_0, after_0),(before_1, after_1))
 
-def register_frames(filelist, translation, save_path):
+def paste(canvas, patch, offset):
+    offset = np.asarray(offset)
+    start = np.maximum(offset, 0)
+    stop = np.minimum(offset+patch.shape, canvas.shape)
+    if np.any(stop<=start):
+        return
+    canvas[start[0]:stop[0],start[1]:stop[1]] = patch[start[0]-offset[0]:stop[0]-offset[0],start[1]-offset[1]:stop[1]-offset[1]]
+
+def warp_frame(frame, dx, pad, interpolation="spline", integer_tolerance=0.01):
+    canvas_shape = (frame.shape[0]+pad[0][0]+pad[0][1], frame.shape[1]+pad[1][0]+pad[1][1])
+    output = np.full(canvas_shape, get_fill_value(frame.dtype), dtype=frame.dtype)
+    origin = np.asarray([pad[0][0], pad[1][0]])
+    return warp_into(output, frame, origin, dx, interpolation, integer_tolerance)
+
+def warp_into(output, frame, origin, dx, interpolation="spline", integer_tolerance=0.01):
+    rounded = np.round(dx).astype('int')
+
+    if interpolation=="integer" or np.all(np.abs(dx-rounded)<integer_tolerance):
+        paste(output, frame, origin+rounded)
+        return output
+
+    border = 8 if interpolation=="fourier" else 2
+    base = np.floor(dx).astype('int')
+    source = np.pad(frame.astype('float32'), border, mode='edge')
+    if interpolation=="bilinear":
+        warped = shift(source, dx-base, order=1, mode='nearest')
+    elif interpolation=="spline":
+        warped = shift(source, dx-base, order=3, mode='nearest')
+    elif interpolation=="fourier":
+        spectrum = fourier_shift(rfft2(source), dx-base, n=source.shape[1])
+        warped = irfft2(spectrum, s=source.shape)
+    else:
+        raise ValueError("interpolation must be one of 'integer', 'bilinear', 'spline' or 'fourier'")
+
+    start = rounded-base+border
+    fill = get_fill_value(frame.dtype)
+    warped = np.clip(warped[start[0]:start[0]+frame.shape[0],start[1]:start[1]+frame.shape[1]], *get_value_range(frame.dtype)).astype(frame.dtype)
+    warped[frame>=fill] = fill
+    paste(output, warped, origin+rounded)
+    return output
+
+def is_stale(output, input_time):
+    if not os.path.exists(output):
+        return True
+    return os.path.getmtime(output) < input_time
+
+def get_tiff_options(compression="none", predictor=False, tile=None):
+    if compression not in TIFF_COMPRESSIONS:
+        raise ValueError(f"compression must be one of {', '.join(TIFF_COMPRESSIONS)}")
+    options = {"compression": TIFF_COMPRESSIONS[compression], "predictor": True if predictor==True and compression!="none" else None,
+               "tile": None if tile is None else (int(tile), int(tile))}
+    # Fail before the first slice rather than in the workers
+    try:
+        tifffile.imwrite(io.BytesIO(), np.zeros((32, 32), dtype='uint8'), **options)
+    except (ImportError, KeyError):
+        raise ImportError(f"{compression} TIFF compression requires the imagecodecs package (pip install imagecodecs)")
+    return options
+
+def encode_frame(frame, options):
+    # Returns the compressed strips or tiles of the frame, exactly as tifffile lays them out in a page
+    buffer = io.BytesIO()
+    tifffile.imwrite(buffer, frame, metadata=None, **options)
+    data = buffer.getvalue()
+    with tifffile.TiffFile(io.BytesIO(data)) as tif:
+        page = tif.pages[0]
+        return [data[offset:offset+count] for offset, count in zip(page.dataoffsets, page.databytecounts)]
+
+class TiffWriter:
+    def __init__(self, save_path, compression="none", predictor=False, tile=None):
+        self.save_path = save_path
+        self.options = get_tiff_options(compression, predictor, tile)
+
+    def open(self, filenames, shape, dtype):
+        make_dir(self.save_path)
+        self.filenames = list(filenames)
+
+    def get_slabs(self, n):
+        return [(z, z+1) for z in range(n)]
+
+    def get_path(self, z):
+        return os.path.join(self.save_path, self.filenames[z])
+
+    def is_current(self, z, input_time):
+        return not is_stale(self.get_path(z), input_time)
+
+    def read(self, z):
+        return tifffile.imread(self.get_path(z))
+
+    def write(self, z_start, frames):
+        for z, frame in enumerate(frames, z_start):
+            path = self.get_path(z)
+            tifffile.imwrite(path+".tmp", frame, **self.options)
+            os.replace(path+".tmp", path)
+
+    def close(self):
+        pass
+
+class MultipageTiffWriter:
+    # One BigTIFF for the whole stack: the workers encode the slices and the pages are appended in order by the parent
+    ordered = True
+
+    def __init__(self, save_path, compression="none", predictor=False, tile=None):
+        self.save_path = save_path
+        self.options = get_tiff_options(compression, predictor, tile)
+        self.handle = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["handle"] = None
+        return state
+
+    def get_path(self):
+        return os.path.join(self.save_path, MULTIPAGE_NAME)
+
+    def open(self, filenames, shape, dtype):
+        make_dir(self.save_path)
+        self.filenames, self.shape, self.dtype = list(filenames), tuple(shape), np.dtype(dtype)
+        self.handle = tifffile.TiffWriter(self.get_path()+".tmp", bigtiff=True)
+
+    def get_slabs(self, n):
+        return [(z, z+1) for z in range(n)]
+
+    def is_current(self, z, input_time):
+        return False
+
+    def write(self, z_start, frames):
+        return [encode_frame(frame, self.options) for frame in frames]
+
+    def commit(self, z_start, pages):
+        for z, segments in enumerate(pages, z_start):
+            self.handle.write(iter(segments), shape=self.shape, dtype=self.dtype, description=self.filenames[z], metadata=None, **self.options)
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+            os.replace(self.get_path()+".tmp", self.get_path())
+
+def make_writer(save_path, compression="none", predictor=False, tile=None, multipage=False, zarr=False, n5=False, chunks=ZARR_CHUNKS_DEFAULT, levels=1):
+    if zarr==True or n5==True:
+        return ZarrWriter(save_path, chunks, levels, n5=n5)
+    if multipage==True:
+        return MultipageTiffWriter(save_path, compression, predictor, tile)
+    return TiffWriter(save_path, compression, predictor, tile)
+
+def get_zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError("Zarr/N5 output requires the zarr package (pip install zarr)")
+    return zarr
+
+def open_zarr_group(path, mode, n5=False):
+    zarr = get_zarr()
+    if n5==True:
+        if not hasattr(zarr, "N5FSStore"):
+            raise ImportError("N5 output requires zarr<3, which still provides N5FSStore")
+        return zarr.open_group(zarr.N5FSStore(path), mode=mode)
+    if int(zarr.__version__.split(".")[0])>=3:
+        return zarr.open_group(path, mode=mode, zarr_format=2)
+    return zarr.open_group(path, mode=mode)
+
+def downsample_volume(volume):
+    pad = [(0, size%2) for size in volume.shape]
+    volume = np.pad(volume, pad, mode='edge')
+    shape = [size//2 for size in volume.shape]
+    volume = volume.reshape(shape[0], 2, shape[1], 2, shape[2], 2).mean(axis=(1,3,5))
+    return volume
+
+class ZarrWriter:
+    def __init__(self, save_path, chunks=ZARR_CHUNKS_DEFAULT, levels=1, compression="zstd", n5=False):
+        if chunks[0]%(2**(levels-1))!=0:
+            raise ValueError("The chunk depth must be divisible by 2**(levels-1)")
+        self.save_path = save_path
+        self.chunks = tuple(chunks)
+        self.levels = levels
+        self.compression = compression
+        self.n5 = n5
+
+    def get_compressor(self):
+        if self.compression is None:
+            return None
+        from numcodecs import Blosc
+        return Blosc(cname=self.compression, clevel=5, shuffle=Blosc.BITSHUFFLE)
+
+    def open(self, filenames, shape, dtype):
+        group = open_zarr_group(self.save_path, 'a', self.n5)
+        shape = (len(filenames),)+tuple(shape)
+        datasets = []
+        for level in range(self.levels):
+            level_shape = tuple(int(np.ceil(size/2**level)) for size in shape)
+            level_chunks = (self.chunks[0]//2**level,)+self.chunks[1:]
+            if hasattr(group, "create_array") and self.n5==False:
+                group.create_array(str(level), shape=level_shape, chunks=level_chunks, dtype=dtype, compressors=self.get_compressor(), fill_value=0, overwrite=True)
+            else:
+                group.create_dataset(str(level), shape=level_shape, chunks=level_chunks, dtype=dtype, compressor=self.get_compressor(), fill_value=0, overwrite=True)
+            datasets.append({"path": str(level), "coordinateTransformations": [{"type": "scale", "scale": [2.0**level]*3}]})
+        axes = [{"name": name, "type": "space"} for name in ["z", "y", "x"]]
+        group.attrs["multiscales"] = [{"version": "0.4", "name": os.path.basename(os.path.normpath(self.save_path)), "axes": axes, "datasets": datasets}]
+        group.attrs["filenames"] = list(filenames)
+
+    def get_slabs(self, n):
+        return [(z, min(z+self.chunks[0], n)) for z in range(0, n, self.chunks[0])]
+
+    def is_current(self, z, input_time):
+        return False
+
+    def read(self, z):
+        return open_zarr_group(self.save_path, 'r', self.n5)["0"][z]
+
+    def write(self, z_start, frames):
+        group = open_zarr_group(self.save_path, 'r+', self.n5)
+        volume = np.stack(frames)
+        for level in range(self.levels):
+            if level>0:
+                volume = downsample_volume(volume).astype(frames[0].dtype)
+            z = z_start//2**level
+            group[str(level)][z:z+volume.shape[0]] = volume
+
+    def close(self):
+        pass
+
+def write_stack(writer, reader, shape, dtype, get_frame, skip=None, kind="io", max_jobs=None):
+    write_channels([writer], [reader], shape, [dtype], lambda channel, z: get_frame(z), skip, kind, max_jobs, get_frame.__qualname__.split(".")[0])
+
+def bin_frame(frame, factor):
+    pad = [(0, -size%factor) for size in frame.shape]
+    frame = np.pad(frame.astype('float32'), pad, mode='edge')
+    shape = [size//factor for size in frame.shape]
+    return frame.reshape(shape[0], factor, shape[1], factor).mean(axis=(1,3))
+
+class Preview:
+    # Binned volume and centre reslices accumulated by the workers while the frames are written
+    def __init__(self, n, shape, dtype, factor=PREVIEW_BIN_DEFAULT):
+        self.n, self.shape, self.dtype, self.factor = n, tuple(shape), np.dtype(dtype), factor
+        self.volume = ScratchArray([int(np.ceil(size/factor)) for size in (n,)+self.shape], 'float32')
+        self.xz = ScratchArray((n, self.shape[1]), dtype)
+        self.yz = ScratchArray((n, self.shape[0]), dtype)
+
+    def group_slabs(self, slabs):
+        # Each task owns whole bins along Z, so that no two workers add into the same slice of the volume
+        groups, group = [], []
+        for z_start, z_end in slabs:
+            group.append((z_start, z_end))
+            if z_end%self.factor==0 or z_end==self.n:
+                groups.append(group)
+                group = []
+        return groups
+
+    def add(self, z_start, frames):
+        volume, xz, yz = self.volume.array, self.xz.array, self.yz.array
+        for z, frame in enumerate(frames, z_start):
+            depth = min(self.factor, self.n-z//self.factor*self.factor)
+            volume[z//self.factor] += bin_frame(frame, self.factor)/depth
+            xz[z] = frame[self.shape[0]//2]
+            yz[z] = frame[:,self.shape[1]//2]
+
+    def save(self, save_path, translation):
+        make_dir(save_path)
+        volume = self.volume.array
+        if np.issubdtype(self.dtype, np.integer):
+            info = np.iinfo(self.dtype)
+            volume = np.clip(np.round(volume), info.min, info.max)
+        tifffile.imwrite(os.path.join(save_path, f"volume_bin{self.factor}.tif"), volume.astype(self.dtype))
+        tifffile.imwrite(os.path.join(save_path, "xz.tif"), np.asarray(self.xz.array))
+        tifffile.imwrite(os.path.join(save_path, "yz.tif"), np.asarray(self.yz.array))
+        save_translation_plot(os.path.join(save_path, "dx.png"), translation)
+
+    def close(self):
+        for array in [self.volume, self.xz, self.yz]:
+            array.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def save_translation_plot(path, translation):
+    try:
+        from matplotlib.figure import Figure
+    except ImportError:
+        print("Skipping the translation plot, which requires matplotlib")
+        return
+    translation = np.asarray(translation)
+    figure = Figure(figsize=(8, 4))
+    axes = figure.add_subplot()
+    axes.plot(translation[:,0], label="y")
+    axes.plot(translation[:,1], label="x")
+    axes.set_xlabel("slice")
+    axes.set_ylabel("translation (px)")
+    axes.legend()
+    figure.tight_layout()
+    figure.savefig(path, dpi=100)
+
+def write_channels(writers, readers, shape, dtypes, get_frame, skip=None, kind="io", max_jobs=None, stage=None, preview=None):
+    for writer, reader, dtype in zip(writers, readers, dtypes):
+        writer.open([reader.get_name(z) for z in range(len(reader))], shape, dtype)
+
+    def loop(slabs):
+        encoded = []
+        for z_start, z_end in slabs:
+            if preview is not None and skip is not None and skip(z_start, z_end):
+                # The preview still needs the frames written by a previous run
+                preview.add(z_start, [writers[0].read(z) for z in range(z_start, z_end)])
+                continue
+            for channel, writer in enumerate(writers):
+                frames = [get_frame(channel, z) for z in range(z_start, z_end)]
+                with timed("write", z_start, len(frames)) as record:
+                    record["nbytes"] = sum(frame.nbytes for frame in frames)
+                    pages = writer.write(z_start, frames)
+                if getattr(writer, "ordered", False)==True:
+                    encoded.append((channel, z_start, pages))
+                if channel==0 and preview is not None:
+                    with timed("preview", z_start, len(frames)):
+                        preview.add(z_start, frames)
+        return encoded
+
+    def commit(results):
+        for encoded in results:
+            for channel, z_start, pages in encoded:
+                writers[channel].commit(z_start, pages)
+
+    slabs = writers[0].get_slabs(len(readers[0]))
+    if any(writer.get_slabs(len(readers[0]))!=slabs for writer in writers[1:]):
+        raise ValueError("All channels must be written with the same slab layout (use the same writer type and chunks)")
+    if preview is not None:
+        tasks = [(group,) for group in preview.group_slabs(slabs)]
+    else:
+        if skip is not None:
+            slabs = [slab for slab in slabs if not skip(*slab)]
+        tasks = [([slab],) for slab in slabs]
+
+    # Writers that need their slices in order get them through a write-behind thread, one batch behind the workers
+    batch_size = len(tasks)
+    if any(getattr(writer, "ordered", False)==True for writer in writers):
+        batch_size = 4*get_n_workers()
+    with ThreadPoolExecutor(1) as write_behind:
+        pending = None
+        for i in range(0, len(tasks), max(batch_size, 1)):
+            results = run_parallel(loop, tasks[i:i+batch_size], kind=kind, stage=stage, max_jobs=max_jobs)
+            if pending is not None:
+                pending.result()
+            pending = write_behind.submit(commit, results)
+        if pending is not None:
+            pending.result()
+    for writer in writers:
+        writer.close()
+
+def get_cgroup_memory():
+    # Batch schedulers usually confine jobs to a cgroup, whose limit /proc/meminfo does not show
+    try:
+        with open("/sys/fs/cgroup/memory.max") as f:
+            limit = f.read().strip()
+        with open("/sys/fs/cgroup/memory.current") as f:
+            current = int(f.read())
+    except (OSError, ValueError):
+        return None
+    if limit=="max":
+        return None
+    return int(limit)-current
+
+def get_available_memory():
+    available = os.sysconf("SC_AVPHYS_PAGES")*os.sysconf("SC_PAGE_SIZE")
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1])*1024
+    except OSError:
+        pass
+    cgroup = get_cgroup_memory()
+    return available if cgroup is None else min(available, cgroup)
+
+def get_warp_memory(frame_shape, canvas_shape, dtype, interpolation, slab_depth=1):
+    border = 8 if interpolation=="fourier" else 2
+    frame = np.prod(frame_shape)*np.dtype(dtype).itemsize
+    footprint = (frame_shape[0]+2*border)*(frame_shape[1]+2*border)*WARP_BYTES_PER_PIXEL[interpolation]
+    canvas = np.prod(canvas_shape)*np.dtype(dtype).itemsize
+    # One slab of warped canvases is held before it is written
+    return int(frame+footprint+slab_depth*canvas)
+
+def get_memory_jobs(job_memory, memory_limit=None):
+    if memory_limit is None:
+        memory_limit = MEMORY_FRACTION*get_available_memory()
+    n_jobs = max(1, int(memory_limit//max(job_memory, 1)))
+    return min(n_jobs, get_n_workers())
+
+def get_source_roi(roi, dx, shape, border):
+    # Raw pixels that land in roi (in the coordinates of the registered stack) once shifted by dx
+    base = np.floor(dx).astype('int')
+    return clip_roi([roi[0]-base[0], roi[1]-base[0]+1, roi[2]-base[1], roi[3]-base[1]+1], shape, border)
+
+def check_channels(filelists, translation=None):
+    readers = [get_reader(filelist) for filelist in filelists]
+    errors = []
+    for channel, reader in enumerate(readers[1:], 1):
+        if len(reader)!=len(readers[0]):
+            errors.append(f"channel #{channel+1} has {len(reader)} slices but channel #1 has {len(readers[0])}")
+        if tuple(reader.shape)!=tuple(readers[0].shape):
+            errors.append(f"channel #{channel+1} has {reader.shape[0]}x{reader.shape[1]} frames but channel #1 has {readers[0].shape[0]}x{readers[0].shape[1]}")
+    if translation is not None and len(translation)!=len(readers[0]):
+        errors.append(f"the translation has {len(translation)} slices but the channels have {len(readers[0])}")
+    if len(errors)>0:
+        raise ValueError("Channels do not match: "+"; ".join(errors))
+    return readers
+
+def register_frames(filelist, translation, save_path, interpolation="spline", integer_tolerance=0.01, resume=False, translation_path=None, writer=None, memory_limit=None, roi=None, preview=None):
+    register_channels([filelist], translation, [save_path], interpolation, integer_tolerance, resume, translation_path, None if writer is None else [writer], memory_limit, roi, preview)
+
+def register_channels(filelists, translation, save_paths, interpolation="spline", integer_tolerance=0.01, resume=False, translation_path=None, writers=None, memory_limit=None, roi=None, preview=None):
+    readers = check_channels(filelists, translation)
+    if writers is None:
+        writers = [TiffWriter(save_path) for save_path in save_paths]
 
     pad = pad_from_translation(translation)
+    # Channels may come from different detectors, each keeps its own dtype
+    frame_shape, dtypes = readers[0].shape, [reader.dtype for reader in readers]
+    shape = (frame_shape[0]+pad[0][0]+pad[0][1], frame_shape[1]+pad[1][0]+pad[1][1])
+    if roi is not None:
+        roi = [int(value) for value in roi]
+        shape = (roi[1]-roi[0], roi[3]-roi[2])
+        frame_shape = shape
 
-    def loop(file, dx):
-        frame = tifffile.imread(file).astype('float')
-        frame = np.pad(frame, pad, mode='edge')
-        
-        mask = (frame<255)
-        mask = shift(mask, np.round(dx), cval=0, order=0)
-        
-        frame = shift(frame, dx, cval=255)
-        frame = frame.astype("uint8")
-        frame = frame*mask + 255*(~mask)
-        frame = frame.astype("uint8")
-        
-        filename = os.path.split(file)[1]
-        tifffile.imwrite(os.path.join(save_path, filename), frame)
+    slab_depth = max(z_end-z_start for z_start, z_end in writers[0].get_slabs(len(readers[0])))
+    n_jobs = get_memory_jobs(sum(get_warp_memory(frame_shape, shape, dtype, interpolation, slab_depth) for dtype in dtypes), memory_limit)
+    if n_jobs<get_n_workers():
+        print(f"Registering with {n_jobs} concurrent jobs to fit in memory")
+
+    def get_frame(channel, z):
+        if roi is not None:
+            return get_roi_frame(channel, z)
+        frame = readers[channel].read(z)
+        with timed("warp", z):
+            return warp_frame(frame, translation[z], pad, interpolation, integer_tolerance)
 
-    n_jobs = np.minimum(CPU_COUNT,len(filelist))
-    _ = Parallel(n_jobs=n_jobs)(delayed(loop)(file, dx) for file, dx in zip(filelist, translation))
+    def get_roi_frame(channel, z):
+        output = np.full(shape, get_fill_value(dtypes[channel]), dtype=dtypes[channel])
+        try:
+            source = get_source_roi(roi, translation[z], readers[channel].shape, 8)
+        except ValueError:
+            return output
+        frame = readers[channel].read(z, source)
+        with timed("warp", z):
+            return warp_into(output, frame, np.asarray([source[0]-roi[0], source[2]-roi[2]]), translation[z], interpolation, integer_tolerance)
 
-def registration(load_path, save_path, upsample_factor, mask_crop_step):
+    skip = None
+    if resume==True:
+        translation_time = 0 if translation_path is None else os.path.getmtime(translation_path)
+        def skip(z_start, z_end):
+            return all(writer.is_current(z, max(reader.get_mtime(z), translation_time)) for writer, reader in zip(writers, readers) for z in range(z_start, z_end))
+
+    if preview is None:
+        write_channels(writers, readers, shape, dtypes, get_frame, skip, kind="cpu", max_jobs=n_jobs, stage="register_frames")
+        return
+    # The preview of the first channel is built from the warped frames, without reading the output back
+    with Preview(len(readers[0]), shape, dtypes[0], preview) as accumulator:
+        write_channels(writers, readers, shape, dtypes, get_frame, skip, kind="cpu", max_jobs=n_jobs, stage="register_frames", preview=accumulator)
+        accumulator.save(os.path.join(save_paths[0], PREVIEW_NAME), translation)
+
+def estimate_translation(filelist, translation_path, upsample_factor, mask_crop_step, pyramid=1, reuse_translation=False, skip=1, region=None, crop_start=0, crop_end=None, resume=False, pyramid_window=PYRAMID_WINDOW_DEFAULT, window=None, fft_workers=1):
+    params = {"upsample_factor": upsample_factor, "mask_crop_step": mask_crop_step, "pyramid": pyramid, "pyramid_window": pyramid_window, "window": window, "skip": skip, "crop_start": crop_start, "crop_end": crop_end, "roi": region}
+    if reuse_translation==True and os.path.exists(translation_path):
+        return load_translation(translation_path, filelist)["translation"]
+    if resume==True and os.path.exists(translation_path):
+        # Rewriting the translation would make every registered slice stale, so it is kept unless it no longer matches the stack or the parameters
+        try:
+            saved = load_translation(translation_path, filelist)
+        except ValueError as error:
+            saved = None
+            print(f"Estimating the translation again: {error}")
+        if saved is not None and saved["params"]==json.loads(json.dumps(params)) and len(saved["changed"])==0:
+            return saved["translation"]
+        if saved is not None:
+            print(f"Estimating the translation again: the parameters or slices changed since {translation_path} was saved")
+
+    stack = filelist if region is None else CroppedReader(filelist, region)
+    translation, pairs = get_translation(stack, upsample_factor, mask_crop_step, pyramid, window=window, fft_workers=fft_workers, return_pairs=True, skip=skip, pyramid_window=pyramid_window)
+    save_translation(translation_path, filelist, translation, pairs, params)
+    return translation
+
+def registration(load_path, save_path, upsample_factor, mask_crop_step, pyramid=1, interpolation="spline", crop_start=0, crop_end=None, translation_path=None, reuse_translation=False, resume=False, writer=None, skip=1, memory_limit=None, roi=None, roi_margin=ROI_MARGIN_DEFAULT, preview=None, pyramid_window=PYRAMID_WINDOW_DEFAULT, window=None, fft_workers=1):
 
     make_dir(save_path)
 
+    filelist = get_reader(load_path)[crop_start:crop_end]
+    region = None
+    if roi is not None:
+        region = clip_roi(roi, filelist.shape, roi_margin)
+
+    if translation_path is None:
+        translation_path = os.path.join(save_path, TRANSLATION_NAME)
+
+    translation = estimate_translation(filelist, translation_path, upsample_factor, mask_crop_step, pyramid, reuse_translation, skip, region, crop_start, crop_end, resume, pyramid_window, window, fft_workers)
+
+    register_frames(filelist, translation, save_path, interpolation, resume=resume, translation_path=translation_path, writer=writer, memory_limit=memory_limit, roi=region, preview=preview)
+
+    return translation
+
+def channel_registration(load_paths, save_paths, upsample_factor, mask_crop_step, pyramid=1, interpolation="spline", crop_starts=None, crop_ends=None, translation_path=None, reuse_translation=False, resume=False, writers=None, skip=1, memory_limit=None, roi=None, roi_margin=ROI_MARGIN_DEFAULT, preview=None, pyramid_window=PYRAMID_WINDOW_DEFAULT, window=None, fft_workers=1):
+    # The translation is estimated on the first channel and applied to all of them in one warp pass
+    if crop_starts is None:
+        crop_starts = [0]*len(load_paths)
+    if crop_ends is None:
+        crop_ends = [None]*len(load_paths)
+
+    filelists = [get_reader(load_path)[crop_start:crop_end] for load_path, crop_start, crop_end in zip(load_paths, crop_starts, crop_ends)]
+    check_channels(filelists)
+    for save_path in save_paths:
+        make_dir(save_path)
+
+    region = None
+    if roi is not None:
+        region = clip_roi(roi, filelists[0].shape, roi_margin)
+
+    if translation_path is None:
+        translation_path = os.path.join(save_paths[0], TRANSLATION_NAME)
+
+    translation = estimate_translation(filelists[0], translation_path, upsample_factor, mask_crop_step, pyramid, reuse_translation, skip, region, crop_starts[0], crop_ends[0], resume, pyramid_window, window, fft_workers)
+
+    register_channels(filelists, translation, save_paths, interpolation, resume=resume, translation_path=translation_path, writers=writers, memory_limit=memory_limit, roi=region, preview=preview)
+
+    return translation
+
+def get_ready_files(load_path, done, settle_time):
     filelist = make_filelist(load_path)
+    new = filelist[done:]
+    # A slice is complete once a later one exists or it has not been modified for settle_time
+    while len(new)>0 and time()-os.path.getmtime(new[-1])<settle_time:
+        new = new[:-1]
+    return filelist[:done], new
+
+def follow_registration(load_path, save_path, upsample_factor, mask_crop_step, pyramid=1, interpolation="spline", margin=MARGIN_DEFAULT,
+                        poll_interval=POLL_DEFAULT, settle_time=None, idle_timeout=None, writer=None):
+    make_dir(save_path)
+    if writer is None:
+        writer = TiffWriter(save_path)
+    translation_path = os.path.join(save_path, TRANSLATION_NAME)
+    if settle_time is None:
+        settle_time = poll_interval
 
-    translation = get_translation(filelist, upsample_factor, mask_crop_step)
+    translation, done = np.zeros((0, 2)), 0
+    if os.path.exists(translation_path):
+        saved = load_translation(translation_path)
+        translation, done = saved["translation"], len(saved["filenames"])
+        margin = saved["params"].get("margin", margin)
+        names = [os.path.basename(file) for file in make_filelist(load_path)[:done]]
+        if names!=saved["filenames"]:
+            raise ValueError(f"{translation_path} does not match the first {done} slices of {load_path}")
+        print(f"Resuming after slice {done}")
+    pad = ((margin, margin), (margin, margin))
 
-    register_frames(filelist, translation, save_path)
+    last_update = time()
+    try:
+        while True:
+            previous, new = get_ready_files(load_path, done, settle_time)
+            if len(new)==0:
+                if idle_timeout is not None and time()-last_update>idle_timeout:
+                    print(f"No new slice for {idle_timeout}s, stopping")
+                    break
+                sleep(poll_interval)
+                continue
 
+            # Each batch is registered against the last slice of the previous one, so the translation keeps accumulating
+            batch = previous[-1:]+new
+            reader = TiffDirReader(batch)
+            if len(batch)>1:
+                dx, pairs = get_translation(reader, upsample_factor, mask_crop_step, pyramid, return_pairs=True)
+            else:
+                dx, pairs = np.zeros((1, 2)), np.zeros((0, len(PAIR_COLUMNS)))
+            if done>0:
+                batch_translation, reader = translation[-1]+dx[1:], reader[1:]
+            else:
+                batch_translation = dx
+                pairs = np.concatenate([np.zeros((1, len(PAIR_COLUMNS))), pairs], axis=0)
+
+            if np.any(np.abs(batch_translation)>margin):
+                print(f"Warning: the translation exceeds the margin of {margin} pixels, frames are clipped")
+            def get_frame(z):
+                return warp_frame(reader.read(z), batch_translation[z], pad, interpolation)
+            shape = (reader.shape[0]+2*margin, reader.shape[1]+2*margin)
+            write_stack(writer, reader, shape, reader.dtype, get_frame, kind="cpu")
+
+            if done==0:
+                params = {"upsample_factor": upsample_factor, "mask_crop_step": mask_crop_step, "pyramid": pyramid, "margin": margin, "follow": True}
+                save_translation(translation_path, reader, batch_translation, pairs[1:], params)
+            else:
+                append_translation(translation_path, reader, batch_translation, pairs, done)
+            translation = np.concatenate([translation, batch_translation], axis=0)
+            done += len(new)
+            last_update = time()
+            print(f"Registered {len(new)} new slices ({done} total), last translation {translation[-1].round(2)}")
+    except KeyboardInterrupt:
+        print(f"Stopped after {done} slices")
+
+    return translation
 
+def make_params_writer(params, save_path):
+    return make_writer(save_path, params["compression"], params["predictor"]==1, params["tile"], params["multipage"]==1, params["zarr"]==1, params["n5"]==1, params["chunks"], params["levels"])
 
+def run_experiment(params, i):
+    start_time = time()
+
+    load_path, save_path = params["load_paths"][i], params["save_paths"][i]
+    crop_start, crop_end = params["crop_start"][i], params["crop_end"][i]
+
+    if params["task"]=="preprocessing":
+        padding = params["pad"]
+        means_smoothing = params["smooth"]
+
+        filelist = get_reader(load_path)[crop_start:crop_end]
+
+        writer = make_params_writer(params, save_path)
+        preprocess_data(filelist, save_path, params['crop'], params['norm'], params['invert'], padding, means_smoothing, writer, params["norm_mode"], params["lookahead"])
+
+    if params["task"]=="registration":
+        upsample_factor = params["upsample"]
+        mask_crop_step = params["maskcrop"]
+        pyramid = params["pyramid"]
+        skip = params["skip"]
+
+        registration(load_path, save_path, upsample_factor, mask_crop_step, pyramid, params["interpolation"], crop_start=crop_start, crop_end=crop_end, reuse_translation=params["reuse"]==1, resume=params["resume"]==1, writer=make_params_writer(params, save_path), skip=skip, roi=params["roi"], roi_margin=params["roi_margin"], preview=params["preview"], pyramid_window=params["pyramid_window"],
+                     window="shared" if params["shared_window"]==1 else None, fft_workers=params["fft_workers"])
+
+    total_time = time()-start_time
+    print(f"Exp #{i+1} finished in {total_time:.2f}s")
+
+def run_simultaneous(params):
+    start_time = time()
+
+    channel_registration(params["load_paths"], params["save_paths"], params["upsample"], params["maskcrop"], params["pyramid"], params["interpolation"], crop_starts=params["crop_start"], crop_ends=params["crop_end"],
+                         reuse_translation=params["reuse"]==1, resume=params["resume"]==1, writers=[make_params_writer(params, save_path) for save_path in params["save_paths"]], skip=params["skip"], roi=params["roi"], roi_margin=params["roi_margin"], preview=params["preview"], pyramid_window=params["pyramid_window"],
+                     window="shared" if params["shared_window"]==1 else None, fft_workers=params["fft_workers"])
+
+    total_time = time()-start_time
+    print(f"Exps #1-{params['numexp']} finished in {total_time:.2f}s")
+
+def run_experiments(params, simultaneous=False, max_experiments=1, n_workers=CPU_COUNT, io_limit=4, profile_path=None, use_cprofile=False):
+    start = time()
+
+    for i in range(params["numexp"]):
+        params["crop_start"][i] = int(params["crop_start"][i])
+        if params["crop_end"][i]=="" or params["crop_end"][i] is None:
+            params["crop_end"][i] = None
+        else:
+            params["crop_end"][i] = int(params["crop_end"][i])
+
+    if params["task"]=="preprocessing":
+        print("Processing data...")
+    if params["task"]=="registration":
+        print("Registering data...")
+
+    with Profiler(profile_path, use_cprofile) if profile_path is not None or use_cprofile==True else nullcontext():
+        if simultaneous==True and params["task"]=="registration":
+            run_simultaneous(params)
+        elif max_experiments<=1:
+            for i in range(params['numexp']):
+                run_experiment(params, i)
+        else:
+            scheduler = Scheduler(n_workers, io_limit, max_experiments)
+            experiments = [(f"Exp #{i+1}", lambda i=i: run_experiment(params, i)) for i in range(params['numexp'])]
+            scheduler.run(experiments)
 
+    code_time = time()-start
+    print(f"Code finished in {code_time:.2f}s")